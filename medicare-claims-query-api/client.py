@@ -1,14 +1,28 @@
 """Test EC2 JSON api. See https://github.com/nsh87/medicare-claims-query-api
 for more info on the code base.
+
+Responses can be cached on disk by setting CACHE_DIR. Cached responses are
+revalidated with the server on every request and reused if the server answers
+304 Not Modified, or if the server can't be reached and they are less than
+CACHE_MAX_AGE seconds old::
+
+    import client
+    client.CACHE_DIR = os.path.expanduser('~/.cache/medicare-api')
+    client.get_counts('sex')
 """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
 import json
-import urllib2
 import os
+import time
+import urllib
+from multiprocessing.pool import ThreadPool
+
+import requests
 
 SERVER = 'http://localhost:7000'
 
@@ -16,8 +30,258 @@ current_dir = os.path.dirname(os.path.realpath(__file__))
 if os.path.isfile(os.path.join(current_dir, 'PRODUCTION')):
     SERVER = 'http://52.32.95.188'
 
+# Seconds to wait for the server to respond before giving up on a request
+TIMEOUT = 30
+# Times to retry a request that failed to connect, timed out or got one of
+# RETRY_STATUSES, waiting BACKOFF * 2 ** attempt seconds before each retry
+MAX_RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUSES = (502, 503, 504)
+# Most requests bulk_fetch() makes at once
+MAX_WORKERS = 8
+
+# Directory to cache responses in, or None to not cache them
+CACHE_DIR = None
+# Seconds a cached response can be used for when the server can't be reached
+CACHE_MAX_AGE = 24 * 60 * 60
+# Most bytes to keep in CACHE_DIR. The least recently used responses are
+# deleted to stay under it.
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# All requests share one session, so connections to the server are kept alive
+# and reused
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=MAX_WORKERS))
+session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=MAX_WORKERS))
+
+
+def api_url(path, year=None):
+    """
+    Make the URL of an API route.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path of the route, e.g. '/api/v1/count/sex'.
+    year : int, str, unicode
+        Optional year, range of years like '2008-2009', or 'all' to query.
+        Defaults to the server's default year.
+
+    Returns
+    -------
+    str
+        The full URL.
+    """
+    url = SERVER + path
+    if year is not None:
+        url += '?' + urllib.urlencode({'year': year})
+    return url
+
+
+def cache_path(url):
+    """
+    Get the path of the file in CACHE_DIR that caches the response to a URL.
+
+    Parameters
+    ----------
+    url : str, unicode
+        The URL of the request.
+
+    Returns
+    -------
+    str
+        Path to the cache file.
+    """
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+    return os.path.join(CACHE_DIR, name)
+
+
+def cache_get(url):
+    """
+    Get the cached response to a URL.
+
+    Parameters
+    ----------
+    url : str, unicode
+        The URL of the request.
+
+    Returns
+    -------
+    dict
+        The cache entry, with keys 'url', 'body', 'etag', 'last_modified' and
+        'stored' (the time the response was last stored or revalidated), or
+        None if the response isn't cached.
+    """
+    try:
+        with open(cache_path(url), 'r') as f:
+            entry = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if entry.get('url') != url:
+        return None
+    return entry
+
+
+def cache_put(url, body, etag=None, last_modified=None):
+    """
+    Cache the response to a URL, then evict the least recently used responses
+    if the cache is bigger than CACHE_MAX_BYTES.
+
+    Parameters
+    ----------
+    url : str, unicode
+        The URL of the request.
+    body : str, unicode
+        The body of the response.
+    etag : str, unicode
+        The response's ETag header, if any.
+    last_modified : str, unicode
+        The response's Last-Modified header, if any.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        try:
+            os.makedirs(CACHE_DIR)
+        except OSError:
+            pass  # Another thread made it first
+    path = cache_path(url)
+    entry = {
+        'url': url,
+        'body': body,
+        'etag': etag,
+        'last_modified': last_modified,
+        'stored': time.time(),
+    }
+    # Write to a temporary file and rename it, so readers never see a partial
+    # entry
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f)
+    os.rename(tmp_path, path)
+    cache_evict()
+
 
-def get_counts(col):
+def cache_evict():
+    """
+    Delete the least recently used responses in CACHE_DIR until it holds at
+    most CACHE_MAX_BYTES.
+    """
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except OSError:
+            pass
+        total -= size
+
+
+def get(url, headers=None, timeout=TIMEOUT, retries=MAX_RETRIES):
+    """
+    Make a GET request to the server, retrying with exponential backoff.
+
+    Requests that fail to connect, time out, or get a 502, 503 or 504 response
+    are retried. If the server sends a Retry-After header, it is waited for
+    instead of the backoff.
+
+    Parameters
+    ----------
+    url : str, unicode
+        The URL to get.
+    headers : dict
+        Optional headers to send.
+    timeout : float
+        Seconds to wait for the server to respond.
+    retries : int
+        Times to retry a failed request.
+
+    Returns
+    -------
+    requests.Response
+        The response.
+
+    Raises
+    ------
+    requests.RequestException
+        If the request still fails to connect or times out after all retries.
+    """
+    for attempt in range(retries + 1):
+        wait = BACKOFF * 2 ** attempt
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        else:
+            if (response.status_code not in RETRY_STATUSES or
+                    attempt == retries):
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                wait = int(retry_after)
+        time.sleep(wait)
+
+
+def fetch_json(url, timeout=TIMEOUT, retries=MAX_RETRIES):
+    """
+    Get a JSON response from the server, from the cache in CACHE_DIR if it's
+    still valid.
+
+    Parameters
+    ----------
+    url : str, unicode
+        The URL to get.
+    timeout : float
+        Seconds to wait for the server to respond.
+    retries : int
+        Times to retry a failed request.
+
+    Returns
+    -------
+    dict
+        The decoded JSON response.
+
+    Raises
+    ------
+    requests.RequestException
+        If the request fails, and there's no cached response less than
+        CACHE_MAX_AGE seconds old to use instead.
+    """
+    entry = cache_get(url) if CACHE_DIR else None
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response = get(url, headers, timeout, retries)
+    except (requests.ConnectionError, requests.Timeout):
+        if entry is not None and time.time() - entry['stored'] < CACHE_MAX_AGE:
+            return json.loads(entry['body'])
+        raise
+    if response.status_code == 304 and entry is not None:
+        cache_put(url, entry['body'], entry['etag'], entry['last_modified'])
+        return json.loads(entry['body'])
+    response.raise_for_status()
+    if CACHE_DIR:
+        cache_put(url, response.text, response.headers.get('ETag'),
+                  response.headers.get('Last-Modified'))
+    return response.json()
+
+
+def get_counts(col, year=None):
     """
     Get counts by distinct values in a given column.
 
@@ -25,19 +289,18 @@ def get_counts(col):
     ----------
     col : str, unicode
         Column to count distinct values within.
+    year : int, str, unicode
+        Optional year, range of years, or 'all' to query.
 
     Returns
     -------
     dict
         A dictionary of values and counts.
     """
-    out = dict()
-    response = urllib2.urlopen(SERVER + '/api/v1/count/' + col)
-    out = response.read()
-    return json.loads(out)
+    return fetch_json(api_url('/api/v1/count/' + col, year))
 
 
-def get_state_disease_freq(disease):
+def get_state_disease_freq(disease, year=None):
     """
     Get the frequency of disease claims by state in descending order.
 
@@ -45,6 +308,8 @@ def get_state_disease_freq(disease):
     ----------
     disease : str, unicode
         A disease corresponding to a column name.
+    year : int, str, unicode
+        Optional year, range of years, or 'all' to query.
 
     Returns
     -------
@@ -52,14 +317,10 @@ def get_state_disease_freq(disease):
         A list of dictionaries with state abbreviation as keys and frequency
         of disease claims as value.
     """
-    out = dict()
-    print(SERVER + '/api/v1/freq/' + disease)
-    response = urllib2.urlopen(SERVER + '/api/v1/freq/' + disease)
-    out = response.read()
-    return json.loads(out)
+    return fetch_json(api_url('/api/v1/freq/' + disease, year))
 
 
-def get_avg_col(col):
+def get_avg_col(col, year=None):
     """
     Get the average value of a column.
 
@@ -67,6 +328,8 @@ def get_avg_col(col):
     ----------
     col : str, unicode
         The column to get the average of.
+    year : int, str, unicode
+        Optional year, range of years, or 'all' to query.
 
     Returns
     -------
@@ -74,52 +337,111 @@ def get_avg_col(col):
         A dictionary whose key is the column name and the value is the average
         value of that column.
     """
-    out = dict()
-    response = urllib2.urlopen(SERVER + '/api/v1/average/{0}'.format(col))
-    results = json.loads(response.read())
+    results = fetch_json(api_url('/api/v1/average/{0}'.format(col), year))
     return results['average']
 
 
+# Functions bulk_fetch() can call, by request type
+FETCHERS = {
+    'count': get_counts,
+    'average': get_avg_col,
+    'freq': get_state_disease_freq,
+}
+
+
+def bulk_fetch(reqs, max_workers=MAX_WORKERS):
+    """
+    Fetch many counts, averages and frequencies at once.
+
+    Requests are made concurrently, at most `max_workers` at a time, over
+    kept-alive connections, so fetching a whole report takes about as long as
+    its slowest request.
+
+    Parameters
+    ----------
+    reqs : list
+        Requests as tuples of (type, column) or (type, column, year), where
+        type is one of 'count', 'average' or 'freq'. For example::
+
+            [('count', 'sex'), ('average', 'inpatient_reimbursement', 2009)]
+
+    max_workers : int
+        Most requests to make at once.
+
+    Returns
+    -------
+    dict
+        A dictionary whose keys are the request tuples and whose values are
+        what get_counts(), get_avg_col() or get_state_disease_freq() return
+        for them. If a request failed, its value is the exception it raised.
+    """
+    def fetch(req):
+        try:
+            return FETCHERS[req[0]](*req[1:])
+        except Exception as e:
+            return e
+    reqs = list(reqs)
+    pool = ThreadPool(max(1, min(max_workers, len(reqs))))
+    try:
+        results = pool.map(fetch, reqs)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(reqs, results))
+
+
 if __name__ == '__main__':
+    reports = bulk_fetch([
+        ('count', 'sex'),
+        ('count', 'heart_failure'),
+        ('freq', 'depression'),
+        ('freq', 'diabetes'),
+        ('average', 'inpatient_reimbursement'),
+        ('average', 'outpatient_reimbursement'),
+        ('average', 'beneficiary_responsibility'),
+    ])
+    for req, result in reports.items():
+        if isinstance(result, Exception):
+            raise result
     print("*********************************************")
     print("test of my flask app runn at {0}".format(SERVER))
     print("created by Nikhil Haas")
     print("*********************************************")
     print("")
     print("*********** count claims by sex *************")
-    for k, v in get_counts('sex').iteritems():
+    for k, v in reports[('count', 'sex')].iteritems():
         print("{0}: {1}".format(k, v))
     print("*********************************************")
     print("")
     print("******* count heart failures claims *********")
-    for k, v in get_counts('heart_failure').iteritems():
+    for k, v in reports[('count', 'heart_failure')].iteritems():
         print("{0}: {1}".format(k, v))
     print("*********************************************")
     print("")
     print("**** get rate of state depression claims ****")
-    depression_rates = get_state_disease_freq('depression')
+    depression_rates = reports[('freq', 'depression')]
     for state in depression_rates['state_depression']:
         print("{0}: {1}".format(state.keys()[0], state.values()[0]))
     print("*********************************************")
     print("")
     print("********** get most diabetic states *********")
-    diabetes_rates = get_state_disease_freq('diabetes')
+    diabetes_rates = reports[('freq', 'diabetes')]
     for state in diabetes_rates['state_depression']:
         print("{0}: {1}".format(state.keys()[0], state.values()[0]))
     print("*********************************************")
     print("")
     print("****** average inpatient reimbursement ******")
-    reimb = get_avg_col('inpatient_reimbursement')
+    reimb = reports[('average', 'inpatient_reimbursement')]
     print("{0}: {1}".format(reimb.keys()[0], reimb.values()[0]))
     print("*********************************************")
     print("")
     print("***** average outpatient reimbursement ******")
-    reimb = get_avg_col('outpatient_reimbursement')
+    reimb = reports[('average', 'outpatient_reimbursement')]
     print("{0}: {1}".format(reimb.keys()[0], reimb.values()[0]))
     print("*********************************************")
     print("")
     print("**** average beneficiary responsibility *****")
-    reimb = get_avg_col('beneficiary_responsibility')
+    reimb = reports[('average', 'beneficiary_responsibility')]
     print("{0}: {1}".format(reimb.keys()[0], reimb.values()[0]))
     print("*********************************************")
     print("")
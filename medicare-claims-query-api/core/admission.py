@@ -0,0 +1,101 @@
+"""Admission control for the API, to shed load instead of overloading the DB."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limits how many requests run at once, with a bounded queue of requests
+    waiting for a turn.
+
+    A request is admitted straight away if fewer than `max_active` are running.
+    Otherwise it waits in the queue for up to `queue_timeout` seconds, unless
+    `max_queued` requests are already waiting, in which case it is rejected
+    straight away.
+
+    Parameters
+    ----------
+    max_active : int
+        Most requests that can run at once.
+    max_queued : int
+        Most requests that can wait for a turn.
+    queue_timeout : float
+        Most seconds a request waits for a turn before being rejected.
+    """
+
+    def __init__(self, max_active, max_queued, queue_timeout):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a turn to run a request.
+
+        Returns
+        -------
+        bool
+            True if the request was admitted, in which case release() must be
+            called when it's done. False if it was rejected.
+        """
+        with self._cond:
+            if self.active >= self.max_active:
+                if self.queued >= self.max_queued:
+                    self.rejected += 1
+                    return False
+                self.queued += 1
+                deadline = time.time() + self.queue_timeout
+                try:
+                    while self.active >= self.max_active:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.timed_out += 1
+                            self.rejected += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """
+        Finish a request admitted by acquire(), letting the next one run.
+        """
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def status(self):
+        """
+        Get the limiter's current load and counters.
+
+        Returns
+        -------
+        dict
+            The limits, the number of requests running and queued, and the
+            number admitted, rejected and rejected after timing out in the
+            queue so far.
+        """
+        with self._cond:
+            return {
+                'max_active': self.max_active,
+                'max_queued': self.max_queued,
+                'active': self.active,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
@@ -0,0 +1,237 @@
+"""Timing and throughput instrumentation for the data loader."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import json
+import resource
+import socket
+import time
+from contextlib import contextmanager
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process to its current RSS, by
+    writing 5 to /proc/self/clear_refs. Only Linux supports this.
+
+    Returns
+    -------
+    bool
+        True if the peak was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_rss_kb():
+    """
+    Get the peak resident set size of this process since it started, or since
+    reset_peak_rss() last reset it.
+
+    Returns
+    -------
+    int
+        Peak RSS in kilobytes.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageStats(object):
+    """
+    Counters for a single stage of a run, updated by the code doing the work.
+
+    The peak RSS recorded for the stage is its own where the peak can be reset
+    when the stage starts, see reset_peak_rss(), and otherwise the peak of the
+    whole process up to the end of the stage. `peak_rss_scope` says which.
+
+    Parameters
+    ----------
+    name : str, unicode
+        Name of the stage, e.g. 'prep'.
+    file_name : str, unicode
+        Name of the file the stage is working on, if any.
+    progress_interval : float
+        Print a progress line at most this often, in seconds, as rows and
+        bytes are added. 0 disables progress lines.
+    """
+
+    def __init__(self, name, file_name=None, progress_interval=0):
+        self.name = name
+        self.file_name = file_name
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.seconds = None
+        self.peak_rss_kb = None
+        self.peak_rss_scope = 'stage' if reset_peak_rss() else 'process'
+        self._progress_interval = progress_interval
+        self._last_progress = self.started
+
+    def add(self, rows=0, nbytes=0):
+        """
+        Add to the number of rows and bytes processed by the stage.
+
+        Parameters
+        ----------
+        rows : int
+            Number of rows processed since the last call.
+        nbytes : int
+            Number of bytes processed since the last call.
+        """
+        self.rows += rows
+        self.bytes += nbytes
+        if self._progress_interval:
+            now = time.time()
+            if now - self._last_progress >= self._progress_interval:
+                self._last_progress = now
+                elapsed = now - self.started
+                print("  [{0}{1}] {2:,d} rows, {3:,d} bytes in {4:.1f}s "
+                      "({5:,.0f} rows/s)".format(
+                          self.name,
+                          " " + self.file_name if self.file_name else "",
+                          self.rows, self.bytes, elapsed,
+                          self.rows / elapsed))
+
+    def finish(self):
+        """
+        Record the wall time and peak RSS of the stage.
+        """
+        self.seconds = time.time() - self.started
+        self.peak_rss_kb = peak_rss_kb()
+
+    def to_dict(self):
+        """
+        Get the stage's measurements.
+
+        Returns
+        -------
+        dict
+            Wall time, rows and bytes processed and their rates, and peak RSS
+            and its scope.
+        """
+        seconds = self.seconds or 0
+        return {
+            'stage': self.name,
+            'file': self.file_name,
+            'seconds': round(seconds, 3),
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'rows_per_sec': (round(self.rows / seconds, 1)
+                             if seconds else None),
+            'bytes_per_sec': (round(self.bytes / seconds, 1)
+                              if seconds else None),
+            'peak_rss_kb': self.peak_rss_kb,
+            'peak_rss_scope': self.peak_rss_scope,
+        }
+
+
+class LoadReport(object):
+    """
+    Measurements of every stage of a data load, written out as JSON.
+
+    Parameters
+    ----------
+    progress_interval : float
+        Passed on to each stage's StageStats. 0 disables progress lines.
+    """
+
+    def __init__(self, progress_interval=0):
+        self.progress_interval = progress_interval
+        self.stages = []
+        self.started = time.time()
+        self.status = 'running'
+        # Peak RSS of the whole load, kept here since each stage resets the
+        # process's own peak
+        self._peak_rss_kb = 0
+        # Any other results of the load to include in the report
+        self.info = {}
+
+    @contextmanager
+    def stage(self, name, file_name=None):
+        """
+        Measure a stage of the load.
+
+        Use as a context manager around the work done by the stage. The
+        yielded StageStats can be used to count the rows and bytes processed::
+
+            with report.stage('copy', filename) as stats:
+                load_csv(...)
+                stats.add(rows=num_rows, nbytes=os.path.getsize(...))
+
+        Parameters
+        ----------
+        name : str, unicode
+            Name of the stage.
+        file_name : str, unicode
+            Name of the file the stage is working on, if any.
+        """
+        self._peak_rss_kb = max(self._peak_rss_kb, peak_rss_kb())
+        stats = StageStats(name, file_name, self.progress_interval)
+        try:
+            yield stats
+        finally:
+            stats.finish()
+            self._peak_rss_kb = max(self._peak_rss_kb, stats.peak_rss_kb)
+            self.stages.append(stats)
+
+    def to_dict(self):
+        """
+        Get the measurements of the whole load.
+
+        Returns
+        -------
+        dict
+            The host, start time, status and total wall time of the load, the
+            measurements of each stage, totals by stage name, and `info`.
+        """
+        totals = {}
+        for stats in self.stages:
+            total = totals.setdefault(stats.name, {
+                'seconds': 0, 'rows': 0, 'bytes': 0})
+            total['seconds'] += stats.seconds
+            total['rows'] += stats.rows
+            total['bytes'] += stats.bytes
+        for total in totals.values():
+            seconds = total['seconds']
+            total['seconds'] = round(seconds, 3)
+            total['rows_per_sec'] = (round(total['rows'] / seconds, 1)
+                                     if seconds else None)
+            total['bytes_per_sec'] = (round(total['bytes'] / seconds, 1)
+                                      if seconds else None)
+        return {
+            'host': socket.gethostname(),
+            'started': datetime.datetime.utcfromtimestamp(
+                self.started).isoformat() + 'Z',
+            'status': self.status,
+            'seconds': round(time.time() - self.started, 3),
+            'peak_rss_kb': max(self._peak_rss_kb, peak_rss_kb()),
+            'stages': [stats.to_dict() for stats in self.stages],
+            'totals': totals,
+            'info': self.info,
+        }
+
+    def write(self, path):
+        """
+        Write the report to a JSON file.
+
+        Parameters
+        ----------
+        path : str, unicode
+            Where to write the report.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
@@ -0,0 +1,223 @@
+"""SQL behind each API route, shared by the server and the data loader.
+
+Each query is a template with `{col}`, `{table}` and `{years}` fields. Column
+names must be checked against a whitelist before being formatted into a query,
+and `{years}` must be a condition returned from year_filter().
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from core import schema
+
+# /api/v1/count/<col>
+COUNT_SQL = """
+SELECT {col}, COUNT(*) AS num FROM {table}
+WHERE {years}
+GROUP BY {col};"""
+
+# /api/v1/average/<col>
+AVERAGE_SQL = "SELECT AVG({col}) FROM {table} WHERE {years};"
+
+# /api/v1/freq/<col>
+FREQ_SQL = """
+SELECT state, {col}/claims::float AS frequency FROM (SELECT
+LHS.state AS state, {col}, claims FROM (SELECT state, count(*) AS
+claims FROM {table} WHERE {years} GROUP BY state order by claims desc)
+AS LHS LEFT JOIN (SELECT state, count(*) AS {col} FROM
+{table} WHERE {col}='true' AND {years} GROUP BY state) AS RHS
+ON LHS.state=RHS.state) AS outer_q
+ORDER by frequency DESC;"""
+
+# Summary views of the table built by the data loader, named by
+# summary_view_name(). The queries against them give the same results as the
+# queries above, for the columns the views cover.
+SUMMARY_VIEWS = ["counts", "averages", "state_totals"]
+
+# /api/v1/count/<col> from the 'counts' view
+SUMMARY_COUNT_SQL = """
+SELECT value AS {col}, SUM(num)::bigint AS num FROM {table}
+WHERE col = %s AND {years}
+GROUP BY value;"""
+
+# /api/v1/average/<col> from the 'averages' view
+SUMMARY_AVERAGE_SQL = """
+SELECT SUM({col}_sum) / SUM({col}_count) AS avg FROM {table}
+WHERE {years};"""
+
+# /api/v1/freq/<col> from the 'state_totals' view
+SUMMARY_FREQ_SQL = """
+SELECT state, NULLIF(SUM({col}), 0) / SUM(claims)::float AS frequency
+FROM {table} WHERE {years}
+GROUP BY state
+ORDER BY frequency DESC;"""
+
+# Approximate versions of the queries above, answered from a TABLESAMPLE SYSTEM
+# sample of `%(percent)s` percent of the table's pages, where `%(fraction)s` is
+# the same as a fraction. Each page is sampled or not independently of the
+# others, so the page is the sampling unit: sampled rows are totaled by page,
+# and standard errors are estimated from the variation between pages. That
+# keeps them honest when rows on the same page are alike, e.g. after the table
+# is clustered by state.
+
+# /api/v1/count/<col>?approx, estimating each count by scaling up its count in
+# the sample
+APPROX_COUNT_SQL = """
+SELECT {col}, SUM(n) AS sample_rows, SUM(n) / %(fraction)s AS estimate,
+SQRT((1 - %(fraction)s) * SUM(n * n)) / %(fraction)s AS std_error
+FROM (SELECT {col}, tableoid, (ctid::text::point)[0] AS page, COUNT(*) AS n
+FROM {table} TABLESAMPLE SYSTEM (%(percent)s) WHERE {years}
+GROUP BY {col}, tableoid, page) AS pages
+GROUP BY {col};"""
+
+# /api/v1/average/<col>?approx, estimating the average by the sample's average
+APPROX_AVERAGE_SQL = """
+WITH pages AS (SELECT tableoid, (ctid::text::point)[0] AS page,
+SUM({col}) AS total, COUNT({col}) AS n
+FROM {table} TABLESAMPLE SYSTEM (%(percent)s) WHERE {years}
+GROUP BY tableoid, page),
+ratio AS (SELECT SUM(total)::float / NULLIF(SUM(n), 0) AS avg FROM pages)
+SELECT avg, SUM(n) AS sample_rows,
+SQRT((1 - %(fraction)s) * SUM((total - avg * n) ^ 2)) / NULLIF(SUM(n), 0)
+AS std_error
+FROM pages, ratio GROUP BY avg;"""
+
+# /api/v1/freq/<col>?approx, estimating each state's frequency by its frequency
+# in the sample
+APPROX_FREQ_SQL = """
+WITH pages AS (SELECT state, tableoid, (ctid::text::point)[0] AS page,
+COUNT(*) AS claims, COUNT(*) FILTER (WHERE {col}) AS cases
+FROM {table} TABLESAMPLE SYSTEM (%(percent)s) WHERE {years}
+GROUP BY state, tableoid, page),
+ratios AS (SELECT state, SUM(cases)::float / SUM(claims) AS frequency
+FROM pages GROUP BY state)
+SELECT state, frequency, SUM(claims) AS sample_rows,
+SQRT((1 - %(fraction)s) * SUM((cases - frequency * claims) ^ 2)) / SUM(claims)
+AS std_error
+FROM pages JOIN ratios USING (state)
+GROUP BY state, frequency
+ORDER BY frequency DESC;"""
+
+# SQL for each aggregate compile_aggregates() can compute, with `{0}` for the
+# column. Averages and standard deviations are cast to float so they can be
+# returned as JSON.
+AGGREGATE_SQL = {
+    'count': "COUNT({0})",
+    'sum': "SUM({0})",
+    'avg': "AVG({0})::float",
+    'min': "MIN({0})",
+    'max': "MAX({0})",
+    'stddev': "STDDEV_SAMP({0})::float",
+}
+
+
+def summary_view_name(table_name, view):
+    """
+    Get the name of a summary view of a table.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        Name of the summarized table.
+    view : str, unicode
+        One of SUMMARY_VIEWS.
+
+    Returns
+    -------
+    str
+        Name of the materialized view, e.g. 'beneficiary_sample_counts'.
+    """
+    return "{0}_{1}".format(table_name, view)
+
+
+def year_filter(first=None, last=None):
+    """
+    Make a SQL condition restricting a query to a range of years.
+
+    The years are written into the condition as literals so that Postgres can
+    prune the table's partitions when it plans the query.
+
+    Parameters
+    ----------
+    first : int
+        First year to include, or None to include all years.
+    last : int
+        Last year to include. Defaults to `first`.
+
+    Returns
+    -------
+    str
+        A SQL condition, e.g. 'year = 2010'.
+    """
+    if first is None:
+        return "TRUE"
+    if last is None or last == first:
+        return "year = {0:d}".format(first)
+    return "year BETWEEN {0:d} AND {1:d}".format(first, last)
+
+
+def compile_aggregates(aggregates, group_by, table_name, years):
+    """
+    Compile any number of aggregates over any columns into a single query, so
+    the table is scanned only once.
+
+    Parameters
+    ----------
+    aggregates : list
+        Tuples of (aggregate, column name), e.g. ('avg', 'cancer'). The column
+        must allow the aggregate in the schema registry. ('count', '*') counts
+        rows.
+    group_by : list
+        Names of categorical or boolean columns to group the aggregates by.
+        May be empty.
+    table_name : str, unicode
+        Name of the table to query.
+    years : str, unicode
+        A condition from year_filter().
+
+    Returns
+    -------
+    str
+        The query. Each aggregate is returned in a column named
+        '<aggregate>_<column>', or 'count' for ('count', '*'), and rows are
+        ordered by the grouped columns.
+
+    Raises
+    ------
+    ValueError
+        If an aggregate isn't allowed over its column, or a column can't be
+        grouped by.
+    """
+    if not aggregates:
+        raise ValueError("at least one aggregate is needed")
+    selects = []
+    for col in group_by:
+        if col not in schema.columns(*schema.GROUP_ROLES):
+            raise ValueError("can't group by column '{0}'".format(col))
+        if col not in selects:
+            selects.append(col)
+    names = set()
+    for aggregate, col in aggregates:
+        if aggregate == 'count' and col == '*':
+            name = 'count'
+            expression = "COUNT(*)"
+        elif aggregate in AGGREGATE_SQL and schema.allows(col, aggregate):
+            name = "{0}_{1}".format(aggregate, col)
+            if schema.COLUMNS[col].role == 'boolean':
+                # Sum and average booleans as 1 for true and 0 for false
+                col += "::int"
+            expression = AGGREGATE_SQL[aggregate].format(col)
+        else:
+            raise ValueError(
+                "aggregate '{0}' is not allowed on column '{1}'".format(
+                    aggregate, col))
+        if name not in names:
+            names.add(name)
+            selects.append("{0} AS {1}".format(expression, name))
+    sql = "SELECT {0} FROM {1} WHERE {2}".format(", ".join(selects),
+                                                 table_name, years)
+    if group_by:
+        group_cols = ", ".join(selects[:len(selects) - len(names)])
+        sql += " GROUP BY {0} ORDER BY {0}".format(group_cols)
+    return sql + ";"
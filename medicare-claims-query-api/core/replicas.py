@@ -0,0 +1,200 @@
+"""Routing of read-only queries across a primary database and its replicas."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import psycopg2
+
+from core.utilities import cursor_connect
+
+# How far behind the primary a replica is, in seconds. A replica that has
+# replayed everything it has received is not behind, even if the primary
+# hasn't written anything for a while.
+LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END;"""
+
+
+class ReplicaRouter(object):
+    """
+    Hands out read-only connections round-robin across the healthy replicas,
+    falling back to the primary when none are healthy.
+
+    Replicas are health checked at most every `check_interval` seconds, when
+    a connection is asked for, by one thread at a time while the others carry
+    on with the replicas found healthy last time. A replica that can't be
+    reached, or that is more than `max_lag` seconds behind the primary, is
+    left out until a later check finds it healthy again. A replica that fails to connect between
+    checks is left out straight away.
+
+    Parameters
+    ----------
+    primary_dsn : str, unicode
+        DSN of the primary database.
+    replica_dsns : list
+        DSNs of the read replicas. May be empty, in which case every
+        connection goes to the primary.
+    max_lag : float
+        Most seconds a replica can be behind the primary and still be used.
+    check_interval : float
+        Seconds between health checks of the replicas.
+    connect_timeout : int
+        Seconds to wait for a replica to accept a connection.
+    """
+
+    def __init__(self, primary_dsn, replica_dsns, max_lag=30,
+                 check_interval=10, connect_timeout=2):
+        self.primary_dsn = primary_dsn
+        self.replica_dsns = list(replica_dsns)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self.healthy = list(self.replica_dsns)
+        self.last_check = None
+        self._next = 0
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+
+    def check_replica(self, dsn):
+        """
+        Check whether a replica can be reached and isn't lagging too far
+        behind the primary.
+
+        Parameters
+        ----------
+        dsn : str, unicode
+            DSN of the replica.
+
+        Returns
+        -------
+        bool
+            True if the replica can be used.
+        """
+        try:
+            con, cur = cursor_connect("{0} connect_timeout={1:d}".format(
+                dsn, self.connect_timeout))
+            try:
+                cur.execute(LAG_SQL)
+                lag = cur.fetchone()[0]
+            finally:
+                con.close()
+        except psycopg2.Error:
+            return False
+        return lag is not None and lag <= self.max_lag
+
+    def check_replicas(self):
+        """
+        Health check every replica and update the list of healthy ones.
+        """
+        healthy = [dsn for dsn in self.replica_dsns
+                   if self.check_replica(dsn)]
+        with self._lock:
+            self.healthy = healthy
+            self.last_check = time.time()
+
+    def eject(self, dsn):
+        """
+        Stop using a replica until the next health check finds it healthy.
+
+        Parameters
+        ----------
+        dsn : str, unicode
+            DSN of the replica.
+        """
+        with self._lock:
+            if dsn in self.healthy:
+                self.healthy.remove(dsn)
+
+    def check_due(self):
+        """
+        Check whether the replicas are due a health check.
+
+        Returns
+        -------
+        bool
+            True if they haven't been checked in `check_interval` seconds.
+        """
+        return (self.last_check is None or
+                time.time() - self.last_check >= self.check_interval)
+
+    def read_dsn(self):
+        """
+        Get the DSN to send the next read-only query to, health checking the
+        replicas first if they're due and no other thread is checking them.
+
+        Returns
+        -------
+        str, unicode
+            DSN of the next healthy replica, or of the primary if no replicas
+            are healthy.
+        """
+        if not self.replica_dsns:
+            return self.primary_dsn
+        if self.check_due() and self._check_lock.acquire(False):
+            try:
+                if self.check_due():
+                    self.check_replicas()
+            finally:
+                self._check_lock.release()
+        with self._lock:
+            if not self.healthy:
+                return self.primary_dsn
+            dsn = self.healthy[self._next % len(self.healthy)]
+            self._next += 1
+        return dsn
+
+    def connect(self, cursor_factory=None, statement_timeout=None):
+        """
+        Connect to a replica for a read-only query, or to the primary if no
+        replica can be connected to.
+
+        Parameters
+        ----------
+        cursor_factory : psycopg2.extras
+            An optional psycopg2 cursor type, e.g. DictCursor.
+        statement_timeout : int
+            If given, Postgres cancels any statement on the connection that
+            runs for longer than this many milliseconds.
+
+        Returns
+        -------
+        (psycopg2.extensions.connection, psycopg2.extensions.cursor)
+            A tuple of (psycopg2 connection, psycopg2 cursor).
+        """
+        options = ""
+        if statement_timeout:
+            options = " options='-c statement_timeout={0:d}'".format(
+                statement_timeout)
+        dsn = self.read_dsn()
+        while dsn != self.primary_dsn:
+            try:
+                return cursor_connect("{0} connect_timeout={1:d}{2}".format(
+                    dsn, self.connect_timeout, options), cursor_factory)
+            except psycopg2.OperationalError:
+                self.eject(dsn)
+            dsn = self.read_dsn()
+        return cursor_connect(dsn + options, cursor_factory)
+
+    def status(self):
+        """
+        Get the replicas' health.
+
+        Returns
+        -------
+        dict
+            The number of replicas, the number that are healthy, and the time
+            of the last health check.
+        """
+        with self._lock:
+            return {
+                'replicas': len(self.replica_dsns),
+                'healthy': len(self.healthy),
+                'last_check': self.last_check,
+            }
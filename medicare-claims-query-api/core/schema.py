@@ -0,0 +1,149 @@
+"""Registry of the columns of the beneficiary table, shared by the data loader
+and the server.
+
+Each column has a role that says what the API may do with it: 'categorical'
+and 'boolean' columns can be grouped by, 'numeric' columns can be summed and
+averaged, and so on. The data loader creates the table from the registry and
+the server checks requests against it.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+# Aggregates each role of column allows by default
+ROLE_AGGREGATES = {
+    'id': (),
+    'date': ('count', 'min', 'max'),
+    'categorical': ('count', ),
+    'boolean': ('count', 'sum', 'avg'),
+    'numeric': ('count', 'sum', 'avg', 'min', 'max', 'stddev'),
+}
+
+# Roles of column that aggregates can be grouped by
+GROUP_ROLES = ('categorical', 'boolean')
+
+
+class Column(object):
+    """
+    A column of the beneficiary table.
+
+    Parameters
+    ----------
+    name : str, unicode
+        Name of the column.
+    sql_type : str, unicode
+        Type of the column when the table is created.
+    role : str, unicode
+        One of the roles in ROLE_AGGREGATES.
+    aggregates : tuple
+        Aggregates the API may compute over the column. Defaults to those
+        allowed by its role.
+    compact_type : str, unicode
+        Type of the column in the compact layout of the table, if narrower
+        than `sql_type`.
+    """
+
+    def __init__(self, name, sql_type, role, aggregates=None,
+                 compact_type=None):
+        self.name = name
+        self.sql_type = sql_type
+        self.role = role
+        if aggregates is None:
+            aggregates = ROLE_AGGREGATES[role]
+        self.aggregates = aggregates
+        self.compact_type = compact_type or sql_type
+
+    def definition(self):
+        """
+        Get the column's definition for a CREATE TABLE statement.
+
+        Returns
+        -------
+        str
+            E.g. 'state VARCHAR(4)'.
+        """
+        return "{0} {1}".format(self.name, self.sql_type)
+
+
+# The table's columns, in the order of the columns in the prepared CSV files
+COLUMNS = OrderedDict((column.name, column) for column in [
+    Column("year", "SMALLINT NOT NULL", "categorical"),
+    Column("id", "CHAR(16)", "id"),
+    # Dates are loaded as text and converted to DATE after loading
+    Column("dob", "CHAR(8)", "date", compact_type="DATE"),
+    Column("dod", "CHAR(8)", "date", compact_type="DATE"),
+    Column("sex", "sex", "categorical"),
+    Column("race", "race", "categorical"),
+    Column("end_stage_renal_disease", "BOOLEAN", "boolean"),
+    # Dictionary encoded as a code in the lookup table in the compact layout
+    Column("state", "VARCHAR(4)", "categorical", compact_type="SMALLINT"),
+    Column("county_code", "INT", "categorical", compact_type="SMALLINT"),
+    Column("part_a_coverage_months", "INT", "numeric",
+           compact_type="SMALLINT"),
+    Column("part_b_coverage_months", "INT", "numeric",
+           compact_type="SMALLINT"),
+    Column("hmo_coverage_months", "INT", "numeric",
+           compact_type="SMALLINT"),
+    Column("part_d_coverage_months", "INT", "numeric",
+           compact_type="SMALLINT"),
+    Column("alzheimers_related_senile", "BOOLEAN", "boolean"),
+    Column("heart_failure", "BOOLEAN", "boolean"),
+    Column("chronic_kidney", "BOOLEAN", "boolean"),
+    Column("cancer", "BOOLEAN", "boolean"),
+    Column("chronic_obstructive_pulmonary", "BOOLEAN", "boolean"),
+    Column("depression", "BOOLEAN", "boolean"),
+    Column("diabetes", "BOOLEAN", "boolean"),
+    Column("ischemic_heart", "BOOLEAN", "boolean"),
+    Column("osteoporosis", "BOOLEAN", "boolean"),
+    Column("rheumatoid_osteo_arthritis", "BOOLEAN", "boolean"),
+    Column("stroke_ischemic_attack", "BOOLEAN", "boolean"),
+    Column("inpatient_reimbursement", "INT", "numeric"),
+    Column("inpatient_beneficiary_responsibility", "INT", "numeric"),
+    Column("inpatient_primary_payer_reimbursement", "INT", "numeric"),
+    Column("outpatient_reimbursement", "INT", "numeric"),
+    Column("outpatient_beneficiary_responsibility", "INT", "numeric"),
+    Column("outpatient_primary_payer_reimbursement", "INT", "numeric"),
+    Column("carrier_reimbursement", "INT", "numeric"),
+    Column("beneficiary_responsibility", "INT", "numeric"),
+    Column("primary_payer_reimbursement", "INT", "numeric"),
+])
+
+
+def columns(*roles):
+    """
+    Get the names of the columns with any of the given roles.
+
+    Parameters
+    ----------
+    roles : str, unicode
+        Roles from ROLE_AGGREGATES.
+
+    Returns
+    -------
+    list
+        Column names, in table order.
+    """
+    return [name for name, column in COLUMNS.items() if column.role in roles]
+
+
+def allows(name, aggregate):
+    """
+    Check whether the API may compute an aggregate over a column.
+
+    Parameters
+    ----------
+    name : str, unicode
+        Name of a column, which doesn't have to exist.
+    aggregate : str, unicode
+        Name of an aggregate, e.g. 'avg'.
+
+    Returns
+    -------
+    bool
+        True if the column exists and allows the aggregate.
+    """
+    column = COLUMNS.get(name)
+    return column is not None and aggregate in column.aggregates
@@ -0,0 +1,420 @@
+"""Columnar snapshots of the beneficiary table, written by the data loader and
+memory-mapped read-only by the server.
+
+A snapshot file is laid out as:
+
+- MAGIC, 8 bytes
+- the length of the header, as a little-endian unsigned 32-bit integer
+- the header, as UTF-8 JSON: the snapshot format, the dataset version and
+  name of the table it was taken from, its number of rows, and for each column
+  its name, encoding, dictionary if it has one, and the offsets of its data and
+  of its null bitmap if it has NULLs
+- the data, with one fixed-width little-endian array per column, each starting
+  at a multiple of ALIGNMENT bytes
+
+Columns are encoded by their role in the schema registry. Booleans are packed
+8 to a byte, categorical text and enum columns are stored as a one byte code
+into a dictionary of their values, dates as the number of days since
+1970-01-01, and integers in the narrowest type of their `compact_type`. Since
+the file is mapped read-only, every server process that opens it shares the
+same pages of the OS page cache, and opening it reads only the header.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import array
+import datetime
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+from collections import Counter, OrderedDict
+
+from core import schema
+
+MAGIC = b"MEDSNAP\x00"
+FORMAT = 1
+ALIGNMENT = 8
+
+# Type code of each fixed-width encoding, for the struct and array modules.
+# 'bits' and 'char' columns are packed into bytes instead.
+TYPECODES = {
+    'int16': 'h',
+    'int32': 'i',
+    'date': 'i',
+    'dict': 'B',
+}
+
+# Rows read at a time when scanning a whole column, and encoded at a time when
+# writing a snapshot. Must be a multiple of 8.
+CHUNK_ROWS = 65536
+
+EPOCH = datetime.date(1970, 1, 1)
+
+# Number of bits set in each byte, for counting packed booleans
+POPCOUNT = [bin(byte).count('1') for byte in range(256)]
+
+
+def column_encoding(column):
+    """
+    Get the encoding of a column in a snapshot.
+
+    Parameters
+    ----------
+    column : schema.Column
+        A column from the schema registry.
+
+    Returns
+    -------
+    str
+        One of 'bits', 'date', 'char', 'int16', 'int32' or 'dict'.
+    """
+    if column.role == 'boolean':
+        return 'bits'
+    if column.role == 'date':
+        return 'date'
+    if column.role == 'id':
+        return 'char'
+    if column.sql_type.startswith(('SMALLINT', 'INT')):
+        if column.compact_type.startswith('SMALLINT'):
+            return 'int16'
+        return 'int32'
+    return 'dict'
+
+
+def aligned(offset):
+    """
+    Round an offset up to a multiple of ALIGNMENT.
+    """
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_snapshot(path, rows, dataset_version, table_name):
+    """
+    Write a snapshot of a table.
+
+    Rows are encoded CHUNK_ROWS at a time, and each chunk of each column and
+    its null bitmap is spilled to a temporary file next to `path`, so memory
+    use doesn't grow with the size of the table. The spilled columns are then
+    copied into place in a temporary file that is renamed over `path`, so
+    processes that have the old snapshot mapped keep reading it undisturbed,
+    and new ones never see a partial file.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path to write the snapshot to.
+    rows : iterable
+        The table's rows, as tuples in the order of schema.COLUMNS.
+    dataset_version : int
+        Version of the table in the data loader's version table.
+    table_name : str, unicode
+        Name of the table.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+
+    Raises
+    ------
+    ValueError
+        If a categorical column has more values than fit in a one byte code.
+    """
+    columns = list(schema.COLUMNS.values())
+    encodings = [column_encoding(column) for column in columns]
+    widths = [int(re.search(r'\((\d+)\)', column.sql_type).group(1))
+              if encoding == 'char' else None
+              for column, encoding in zip(columns, encodings)]
+    dictionaries = [OrderedDict() for column in columns]
+    has_nulls = [False for column in columns]
+    bits = [j for j, encoding in enumerate(encodings) if encoding == 'bits']
+    spill_dir = os.path.dirname(os.path.abspath(path))
+    spills = [(tempfile.TemporaryFile(dir=spill_dir),
+               tempfile.TemporaryFile(dir=spill_dir)) for column in columns]
+
+    def new_chunk():
+        data = [bytearray() if encoding in ('bits', 'char')
+                else array.array(str(TYPECODES[encoding]))
+                for encoding in encodings]
+        nulls = [bytearray() for column in columns]
+        return data, nulls
+
+    def spill(data, nulls):
+        for j, (data_file, nulls_file) in enumerate(spills):
+            block = data[j]
+            if isinstance(block, array.array):
+                if sys.byteorder == 'big':
+                    block.byteswap()
+                block = block.tostring()
+            data_file.write(block)
+            nulls_file.write(nulls[j])
+
+    try:
+        data, nulls = new_chunk()
+        num_rows = 0
+        for row in rows:
+            if num_rows % 8 == 0:
+                # CHUNK_ROWS is a multiple of 8, so packed bits never span
+                # chunks
+                if num_rows and num_rows % CHUNK_ROWS == 0:
+                    spill(data, nulls)
+                    data, nulls = new_chunk()
+                for j in bits:
+                    data[j].append(0)
+                for bitmap in nulls:
+                    bitmap.append(0)
+            for j, value in enumerate(row):
+                encoding = encodings[j]
+                if value is None:
+                    has_nulls[j] = True
+                    nulls[j][-1] |= 1 << (num_rows % 8)
+                    if encoding == 'char':
+                        data[j].extend(b"\x00" * widths[j])
+                    elif encoding != 'bits':
+                        data[j].append(0)
+                elif encoding == 'bits':
+                    if value:
+                        data[j][-1] |= 1 << (num_rows % 8)
+                elif encoding == 'char':
+                    if not isinstance(value, bytes):
+                        value = value.encode('utf-8')
+                    data[j].extend(value.ljust(widths[j], b"\x00"))
+                elif encoding == 'date':
+                    data[j].append((value - EPOCH).days)
+                elif encoding == 'dict':
+                    code = dictionaries[j].setdefault(value,
+                                                      len(dictionaries[j]))
+                    if code > 255:
+                        raise ValueError("column '{0}' has too many values to "
+                                         "encode".format(columns[j].name))
+                    data[j].append(code)
+                else:
+                    data[j].append(value)
+            num_rows += 1
+        spill(data, nulls)
+        del data, nulls
+        # Lay out each column's data and null bitmap, if it has one
+        blocks = []
+        header_columns = []
+        offset = 0
+        for j, column in enumerate(columns):
+            data_file, nulls_file = spills[j]
+            entry = OrderedDict([('name', column.name),
+                                 ('encoding', encodings[j]),
+                                 ('offset', offset)])
+            if widths[j]:
+                entry['width'] = widths[j]
+            if encodings[j] == 'dict':
+                entry['dictionary'] = list(dictionaries[j])
+            blocks.append((offset, data_file))
+            offset = aligned(offset + data_file.tell())
+            if has_nulls[j]:
+                entry['nulls_offset'] = offset
+                blocks.append((offset, nulls_file))
+                offset = aligned(offset + nulls_file.tell())
+            header_columns.append(entry)
+        header = json.dumps(OrderedDict([
+            ('format', FORMAT),
+            ('dataset_version', dataset_version),
+            ('table_name', table_name),
+            ('rows', num_rows),
+            ('columns', header_columns),
+        ])).encode('utf-8')
+        data_start = aligned(len(MAGIC) + 4 + len(header))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack(str('<I'), len(header)))
+            f.write(header)
+            for block_offset, block_file in blocks:
+                f.seek(data_start + block_offset)
+                block_file.seek(0)
+                shutil.copyfileobj(block_file, f)
+            f.truncate(data_start + offset)
+    finally:
+        for data_file, nulls_file in spills:
+            data_file.close()
+            nulls_file.close()
+    os.rename(tmp_path, path)
+    return num_rows
+
+
+class Snapshot(object):
+    """
+    A snapshot written by write_snapshot(), memory-mapped read-only.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path to the snapshot.
+
+    Raises
+    ------
+    ValueError
+        If the file isn't a snapshot in this FORMAT.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("{0} is not a snapshot".format(path))
+        length, = struct.unpack_from(str('<I'), self._map, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(self._map[start:start + length].decode('utf-8'))
+        if header['format'] != FORMAT:
+            raise ValueError("{0} is in snapshot format {1}, not {2}".format(
+                path, header['format'], FORMAT))
+        self.dataset_version = header['dataset_version']
+        self.table_name = header['table_name']
+        self.rows = header['rows']
+        self.columns = OrderedDict((column['name'], column)
+                                   for column in header['columns'])
+        self._data_start = aligned(start + length)
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        """
+        Unmap the snapshot.
+        """
+        self._map.close()
+
+    def _bits(self, offset, start, stop):
+        """
+        Unpack rows `start` to `stop` of a bitmap at an offset in the data.
+        """
+        first = self._data_start + offset + start // 8
+        packed = bytearray(self._map[first:first + (stop + 7) // 8 -
+                                     start // 8])
+        base = start // 8 * 8
+        return [bool(packed[(i - base) // 8] >> (i % 8) & 1)
+                for i in range(start, stop)]
+
+    def raw(self, name, start=0, stop=None):
+        """
+        Read a column's stored values, without decoding dictionary codes and
+        dates or checking for NULLs.
+
+        Parameters
+        ----------
+        name : str, unicode
+            Name of the column.
+        start : int
+            First row to read.
+        stop : int
+            Row to stop reading before. Defaults to the end of the column.
+
+        Returns
+        -------
+        list
+            Dictionary codes, days since 1970-01-01, integers, bools, or byte
+            strings, depending on the column's encoding.
+        """
+        column = self.columns[name]
+        if stop is None or stop > self.rows:
+            stop = self.rows
+        if start >= stop:
+            return []
+        encoding = column['encoding']
+        if encoding == 'bits':
+            return self._bits(column['offset'], start, stop)
+        if encoding == 'char':
+            width = column['width']
+            first = self._data_start + column['offset'] + start * width
+            data = self._map[first:first + (stop - start) * width]
+            return [data[i:i + width].rstrip(b"\x00")
+                    for i in range(0, len(data), width)]
+        typecode = TYPECODES[encoding]
+        first = (self._data_start + column['offset'] +
+                 start * struct.calcsize(str(typecode)))
+        return list(struct.unpack_from(
+            str('<{0:d}{1}').format(stop - start, typecode), self._map, first))
+
+    def values(self, name, start=0, stop=None):
+        """
+        Read a column's values.
+
+        Parameters
+        ----------
+        name : str, unicode
+            Name of the column.
+        start : int
+            First row to read.
+        stop : int
+            Row to stop reading before. Defaults to the end of the column.
+
+        Returns
+        -------
+        list
+            The values, with None for NULLs, as returned by psycopg2 when the
+            snapshot was taken, except that enums and CHAR columns are
+            returned as unicode.
+        """
+        column = self.columns[name]
+        if stop is None or stop > self.rows:
+            stop = self.rows
+        values = self.raw(name, start, stop)
+        encoding = column['encoding']
+        if encoding == 'dict':
+            dictionary = column['dictionary']
+            values = [dictionary[code] for code in values]
+        elif encoding == 'date':
+            values = [EPOCH + datetime.timedelta(days=days)
+                      for days in values]
+        elif encoding == 'char':
+            values = [value.decode('utf-8') for value in values]
+        if 'nulls_offset' in column and start < stop:
+            for i, null in enumerate(
+                    self._bits(column['nulls_offset'], start, stop)):
+                if null:
+                    values[i] = None
+        return values
+
+    def count(self, name):
+        """
+        Count the rows with each value of a column.
+
+        Parameters
+        ----------
+        name : str, unicode
+            Name of the column.
+
+        Returns
+        -------
+        dict
+            The number of rows with each value, with None for NULLs.
+        """
+        column = self.columns[name]
+        if column['encoding'] == 'bits' and 'nulls_offset' not in column:
+            # Count the bits set a byte at a time, the unused bits of the last
+            # byte are never set
+            first = self._data_start + column['offset']
+            last = first + (self.rows + 7) // 8
+            true = 0
+            for start in range(first, last, CHUNK_ROWS):
+                true += sum(POPCOUNT[byte] for byte in bytearray(
+                    self._map[start:min(start + CHUNK_ROWS, last)]))
+            counts = {True: true, False: self.rows - true}
+            return dict((value, num) for value, num in counts.items() if num)
+        counts = Counter()
+        for start in range(0, self.rows, CHUNK_ROWS):
+            if column['encoding'] == 'dict' and 'nulls_offset' not in column:
+                # Count the codes and decode each distinct code only once
+                counts.update(self.raw(name, start, start + CHUNK_ROWS))
+            else:
+                counts.update(self.values(name, start, start + CHUNK_ROWS))
+        if column['encoding'] == 'dict' and 'nulls_offset' not in column:
+            dictionary = column['dictionary']
+            return dict((dictionary[code], num)
+                        for code, num in counts.items())
+        return dict(counts)
@@ -1,4 +1,5 @@
 from db import rds_password
+from core import schema
 import os
 
 # Change the following settings to match your RDS instance
@@ -6,10 +7,18 @@ rds_dbhost = "medicare.chtdutbma0ig.us-west-2.rds.amazonaws.com"  # Change
 rds_dbname = "BENEFICIARYDATA"  # Change
 rds_dbuser = "nikhil"  # Change
 rds_dbpass = rds_password.rds_pass  # Set this in a file `db/rds_password.py`
+# Hostnames of read replicas of rds_dbhost, which read-only API queries are
+# spread across. Leave empty to send every query to rds_dbhost.
+rds_replica_hosts = []  # Change
 
-# Change to correspond to your EC2 IP address and path to .pem file
+# Change to correspond to your EC2 IP addresses and path to .pem file. The API
+# runs on every host in ec2_host, behind Nginx on ec2_lb_host, which can be one
+# of them.
 ec2_pem = os.path.join('/', 'Users', 'Nikhil', '.ssh', 'aws.pem')  # Change
 ec2_host = ['52.32.95.188']  # Change
+ec2_lb_host = ec2_host[0]  # Change
+# Port Gunicorn listens on on each host in ec2_host
+ec2_app_port = 8000
 
 # These settings do not need to be changed
 vagrant_dbhost = "localhost"
@@ -17,5 +26,112 @@ vagrant_dbname = "beneficiary_data"  # Keep lowercase
 vagrant_dbuser = "vagrant"
 vagrant_dbpass = None
 
-# Global table name to use on RDS and Vagrant
-db_tablename = "beneficiary_sample_2010"
+# Global table name to use on RDS and Vagrant. The table is partitioned by
+# year, with a partition for each year in db_years, e.g. beneficiary_sample_2010
+db_tablename = "beneficiary_sample"
+db_years = [2008, 2009, 2010]
+# Year queried by the API when a request doesn't ask for one
+db_default_year = 2010
+
+# Table recording which source files have been loaded, for resumable loads
+db_manifest_tablename = "load_manifest"
+
+# Table recording the version of the loaded data, bumped on every reload
+db_version_tablename = "dataset_version"
+
+# Lookup table of state codes, for the compact layout of the table
+db_state_codes_tablename = "state_codes"
+
+# Indexes built by the data loader after every load, as tuples of (name,
+# indexed columns, partial index condition or None). Names are prefixed with
+# the table name.
+db_disease_columns = schema.columns("boolean")
+db_average_columns = [
+    "inpatient_reimbursement", "outpatient_reimbursement",
+    "beneficiary_responsibility",
+]
+db_indexes = (
+    # /api/v1/count/state and the per-state totals in /api/v1/freq/<disease>
+    [("state", "state", None)] +
+    # Per-state counts of each disease in /api/v1/freq/<disease>
+    [("{0}_state".format(col), "state", col) for col in db_disease_columns] +
+    # Index-only scans for /api/v1/average/<col>
+    [(col, col, None) for col in db_average_columns]
+)
+
+# Materialized views summarizing each year of the table, built by the data
+# loader and read by the API instead of the table where they can answer a
+# query. Columns in db_summary_count_columns are counted by value for
+# /api/v1/count/<col>, and columns in db_summary_average_columns are summed for
+# /api/v1/average/<col>. /api/v1/freq/<disease> reads per-state counts of every
+# column in db_disease_columns. Counted values are stored as text, so only
+# columns whose values sort the same as text should be counted.
+db_summary_count_columns = ["sex", "race", "state"] + db_disease_columns
+db_summary_average_columns = schema.columns("numeric")
+
+# Seconds the web server uses the dataset version for before reading it from
+# the primary again, so cached results can be served for up to this long after
+# the data loader swaps in a new table
+db_version_check_interval = 5
+
+# Replicas further behind the primary than this many seconds aren't queried
+db_replica_max_lag = 30
+# Seconds between health checks of the read replicas
+db_replica_check_interval = 10
+
+# Admission control for each class of API query, per web server process, as
+# tuples of (most queries running at once, most requests waiting to run,
+# Postgres statement_timeout in milliseconds). Requests that can't run get a
+# 503 with a Retry-After header instead of piling more load onto the database.
+db_query_limits = {
+    "count": (4, 8, 10000),
+    "average": (4, 8, 10000),
+    "freq": (2, 4, 20000),
+    "aggregate": (2, 4, 20000),
+}
+# Most seconds a request waits for a turn to run before it gets a 503
+db_queue_timeout = 5
+# Seconds clients are told to wait before retrying after a 503
+db_retry_after = 2
+
+# Percent of the table sampled for approximate answers, when a request passes
+# ?approx without a percent
+db_approx_percent = 1
+
+# Columnar snapshot of the table written by the data loader after every load,
+# which the API's processes memory-map read-only. None to not write one.
+db_snapshot_path = None
+
+# Let requests pass ?profile=1 to be run under cProfile, getting the functions
+# they spent the most time in instead of their usual response. The profiles are
+# also saved to api_profile_dir, if it's set, to be read with pstats.
+api_profiling = False
+api_profile_top = 25
+api_profile_dir = None
+
+# Module used to encode the API's JSON responses. It must have a dumps() that
+# takes the same arguments as json.dumps(), like simplejson.
+api_json_module = "json"
+# Responses of at least this many bytes are compressed with gzip, or with
+# brotli if the brotli package is installed, when the client accepts it
+api_compress_min_bytes = 1024
+api_gzip_level = 6
+api_brotli_quality = 5
+
+# Most hosts `fab aws` sets up or pulls to at once
+deploy_pool_size = 10
+# Rolling restarts wait up to deploy_drain_timeout seconds for a server to
+# finish its requests before restarting it, and up to deploy_health_timeout
+# seconds for it to pass its health check before giving up. Each restarted
+# server's cache is warmed with deploy_warm_urls before it's put back.
+deploy_drain_timeout = 30
+deploy_health_timeout = 60
+deploy_warm_urls = [
+    "/api/v1/count/sex",
+    "/api/v1/count/cancer",
+    "/api/v1/average/inpatient_reimbursement",
+    "/api/v1/average/outpatient_reimbursement",
+    "/api/v1/average/beneficiary_responsibility",
+    "/api/v1/freq/depression",
+    "/api/v1/freq/cancer",
+]
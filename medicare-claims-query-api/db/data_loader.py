@@ -7,9 +7,13 @@ This file is intended to be run during Vagrant or AWS provisioning.
 See https://github.com/nsh87/medicare-claims-query-api for more info on setting
 this up in your own environment.
 
-                 Table "public.beneficiary_sample_2010"
+The data is loaded into a table partitioned by year, with one partition per
+year in `db_years`, e.g. beneficiary_sample_2010.
+
+                   Table "public.beneficiary_sample"
                  Column                 |         Type         | Modifiers
 ----------------------------------------+----------------------+-----------
+ year                                   | smallint             | not null
  id                                     | character(16)        |
  dob                                    | date                 |
  dod                                    | date                 |
@@ -51,11 +55,14 @@ from __future__ import unicode_literals
 import argparse
 import csv
 import glob
-import io
+import hashlib
 import os
 import sys
+import time
 import urlparse
 import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import psycopg2
 import requests
@@ -63,20 +70,75 @@ import requests
 # Need to append parent dir to path so you can import files in sister dirs
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from db import config as dbconfig
+from db import synthetic
+from core import queries
+from core import schema
+from core import snapshot
+from core.instrumentation import LoadReport
 from core.utilities import cursor_connect
 
 TABLE_NAME = dbconfig.db_tablename
+# Data is loaded into a staging table which is swapped in once it is complete
+STAGING_TABLE = TABLE_NAME + "_staging"
+MANIFEST_TABLE = dbconfig.db_manifest_tablename
+VERSION_TABLE = dbconfig.db_version_tablename
+# Compact copy of the live table built by --compact, and its lookup table of
+# state codes
+COMPACT_TABLE = TABLE_NAME + "_compact"
+COMPACT_VIEW = COMPACT_TABLE + "_view"
+STATE_CODES_TABLE = dbconfig.db_state_codes_tablename
 
 # Parse arguments
 argparser = argparse.ArgumentParser(
-    description="Load synthetic CMS 2010 summary beneficiary data into "
+    description="Load synthetic CMS 2008-2010 summary beneficiary data into "
                 "Postgres.",
     epilog="example: python data_loader.py --host localhost --dbname Nikhil "
            "--user Nikhil")
 argparser.add_argument("--host", required=True, help="location of database")
 argparser.add_argument("--dbname", required=True, help="name of database")
 argparser.add_argument("--user", required=True, help="user to access database")
-argparser.add_argument("--password", required=False, help="password to connect")
+argparser.add_argument("--password", required=False,
+                       help="password to connect")
+argparser.add_argument("--years", required=False, type=int, nargs='+',
+                       default=dbconfig.db_years, choices=dbconfig.db_years,
+                       help="years of data to load")
+argparser.add_argument("--rebuild", action="store_true",
+                       help="drop the table and reload every file, ignoring "
+                            "the load manifest")
+argparser.add_argument("--cache-dir", required=False,
+                       default=os.path.join(os.path.dirname(
+                           os.path.abspath(__file__)), 'cache'),
+                       help="directory of downloaded .zip archives to load "
+                            "from and to download missing archives into")
+argparser.add_argument("--offline", action="store_true",
+                       help="never download, only load archives already in "
+                            "the cache directory")
+argparser.add_argument("--synthetic", required=False, type=int, metavar="ROWS",
+                       help="load ROWS rows of generated data in place of "
+                            "each CMS file, for scale testing")
+argparser.add_argument("--seed", required=False, type=int, default=0,
+                       help="random seed for --synthetic data")
+argparser.add_argument("--cluster", action="store_true",
+                       help="physically order the table by state after "
+                            "loading")
+argparser.add_argument("--compact", action="store_true",
+                       help="also build a compact copy of the table, with "
+                            "dictionary-encoded states and narrow integers, "
+                            "and compare its size and scan times to the table")
+argparser.add_argument("--pack-flags", action="store_true",
+                       help="with --compact, also pack the disease flags into "
+                            "a single integer column")
+argparser.add_argument("--snapshot", required=False,
+                       default=dbconfig.db_snapshot_path, metavar="PATH",
+                       help="write a columnar snapshot of the table for the "
+                            "API to memory-map to PATH (default: "
+                            "db_snapshot_path in db/config.py)")
+argparser.add_argument("--report", required=False, default="load_report.json",
+                       help="where to write the JSON timing and throughput "
+                            "report of the load")
+argparser.add_argument("--progress", required=False, type=float, default=0,
+                       help="print a progress line every PROGRESS seconds "
+                            "while preparing each file")
 args = argparser.parse_args()
 
 # Declare URLs of CSV files to download
@@ -84,52 +146,443 @@ base_url = (
     "https://www.cms.gov/Research-Statistics-Data-and-Systems/Downloadable"
     "-Public-Use-Files/SynPUFs/Downloads/some_file.zip"
 )
-# Prep base filename, with 'XX' to be replaced by a two-digit number indicating
-# which file to download.
-base_filename = "DE1_0_2010_Beneficiary_Summary_File_Sample_XX.zip"
+# Prep base filename, with 'YYYY' to be replaced by the year and 'XX' to be
+# replaced by a two-digit number indicating which file to download.
+base_filename = "DE1_0_YYYY_Beneficiary_Summary_File_Sample_XX.zip"
 DATA_FILES = [
-    urlparse.urljoin(base_url, base_filename.replace('XX', '{0}').format(i))
-    for i in range(1, 21)]
+    (year, urlparse.urljoin(base_url, base_filename.replace('YYYY', '{0}')
+                            .replace('XX', '{1}').format(year, i)))
+    for year in dbconfig.db_years for i in range(1, 21)]
+# Number of rows in the full CMS sample for each year
+EXPECTED_ROW_COUNTS = {
+    2008: 2326856,
+    2009: 2291320,
+    2010: 2255098,
+}
+
+
+# File in the cache directory recording the SHA-256 of each cached archive
+CACHE_INDEX = "SHA256SUMS"
+CHUNK_SIZE = 1024 * 1024
+
+# State abbreviation of each SP_STATE_CODE, from 1. Codes 40 and 48 are unused.
+STATES = ('AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC',
+          'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY',
+          'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT',
+          'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH',
+          'OK', 'OR', 'PA', '__', 'RI', 'SC', 'SD', 'TN', 'TX',
+          'UT', 'VT', '__', 'VA', 'WA', 'WV', 'WI', 'WY', 'Othr')
+
+# A query of each shape served by the API, for a single year, timed before and
+# after the table is optimized
+BENCHMARK_QUERIES = [
+    ("count/state", queries.COUNT_SQL, "state"),
+    ("count/cancer", queries.COUNT_SQL, "cancer"),
+    ("average/inpatient_reimbursement", queries.AVERAGE_SQL,
+     "inpatient_reimbursement"),
+    ("freq/depression", queries.FREQ_SQL, "depression"),
+]
+
+
+def sha256_file(path):
+    """
+    Compute the SHA-256 of a file on disk without reading it all into memory.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path to the file.
+
+    Returns
+    -------
+    str
+        The hex digest of the file's contents.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_cache_index(cache_dir):
+    """
+    Read the checksums of the archives in a cache directory.
+
+    Parameters
+    ----------
+    cache_dir : str, unicode
+        The cache directory.
+
+    Returns
+    -------
+    dict
+        A dictionary of archive file names and their SHA-256 hex digests.
+    """
+    index = {}
+    index_path = os.path.join(cache_dir, CACHE_INDEX)
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as f:
+            for line in f:
+                checksum, filename = line.strip().split(None, 1)
+                index[filename] = checksum
+    return index
+
+
+def write_cache_index(cache_dir, index):
+    """
+    Write the checksums of the archives in a cache directory.
+
+    The index is written in the same format as `sha256sum`, so a cache can be
+    checked by hand with `sha256sum -c SHA256SUMS`.
+
+    Parameters
+    ----------
+    cache_dir : str, unicode
+        The cache directory.
+    index : dict
+        A dictionary of archive file names and their SHA-256 hex digests.
+    """
+    index_path = os.path.join(cache_dir, CACHE_INDEX)
+    with open(index_path + '.tmp', 'w') as f:
+        for filename in sorted(index):
+            f.write("{0}  {1}\n".format(index[filename], filename))
+    os.rename(index_path + '.tmp', index_path)
 
 
-def download_zip(uri):
+def download_zip(uri, path):
     """
-    Download an zipped data file and return the unzipped file.
+    Download a zipped data file to disk, streaming it in chunks.
+
+    The file is written to a temporary name and renamed into place once the
+    download completes, so an interrupted download never leaves a truncated
+    archive at `path`.
 
     Parameters
     ----------
     uri : str, unicode
         The URI for the .zip file.
+    path : str, unicode
+        Where to save the .zip file.
 
     Returns
     -------
-    zipfile.ZipExtFile
-        A file-like object holding the file contents. This should be read like
-        any other file, with one of `read()`, `readline()`, or `readlines()`
-        methods::
-
-            for line in f.readlines():
-                print line
-    """
-    r = requests.get(uri)
-    if r.status_code == requests.codes.ok:
-        z = zipfile.ZipFile(io.BytesIO(r.content))
-        csv_file = z.namelist()[0]
-        f = z.open(csv_file)
-    else:
+    str
+        The SHA-256 hex digest of the downloaded file.
+    """
+    r = requests.get(uri, stream=True)
+    if r.status_code != requests.codes.ok:
         raise ValueError(
             "Failed to get {0}. "
             "Returned status code {1}.".format(uri, r.status_code))
-    return f
+    sha = hashlib.sha256()
+    with open(path + '.part', 'wb') as f:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            sha.update(chunk)
+            f.write(chunk)
+    os.rename(path + '.part', path)
+    return sha.hexdigest()
+
+
+def fetch_zip(uri, cache_dir, offline=False):
+    """
+    Get a zipped data file from the cache directory, downloading it if needed.
+
+    Archives already in the cache are verified against the checksum recorded
+    in the cache index. An archive that fails verification is downloaded again,
+    unless `offline` is set, in which case an error is raised. Archives placed
+    in the cache directory by hand are hashed and added to the index the first
+    time they are used.
+
+    Parameters
+    ----------
+    uri : str, unicode
+        The URI for the .zip file.
+    cache_dir : str, unicode
+        The cache directory.
+    offline : bool
+        If True never download, and raise an error for missing archives.
+
+    Returns
+    -------
+    (str, str)
+        A tuple of (path to the .zip file, SHA-256 hex digest of the file).
+    """
+    filename = uri.split('/')[-1]
+    path = os.path.join(cache_dir, filename)
+    index = read_cache_index(cache_dir)
+    if os.path.isfile(path):
+        checksum = sha256_file(path)
+        expected = index.get(filename)
+        if expected is None or expected == checksum:
+            if expected is None:
+                index[filename] = checksum
+                write_cache_index(cache_dir, index)
+            return path, checksum
+        if offline:
+            raise ValueError(
+                "Cached {0} does not match its checksum.".format(filename))
+        print("Cached {0} is corrupt, downloading again.".format(filename))
+    elif offline:
+        raise ValueError("{0} is not in {1} and downloading is disabled."
+                         "".format(filename, cache_dir))
+    print("Downloading {0}".format(filename))
+    checksum = download_zip(uri, path)
+    index[filename] = checksum
+    write_cache_index(cache_dir, index)
+    return path, checksum
+
+
+@contextmanager
+def open_zip(path):
+    """
+    Open the CSV file inside a zipped data file.
+
+    The archive is read from disk and decompressed as it is read, so it is
+    never held in memory in full.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path to the .zip file.
+
+    Returns
+    -------
+    context manager
+        Yields a zipfile.ZipExtFile, a file-like object holding the file
+        contents, and closes it and the archive on exit. It should be read
+        like any other file, with one of `read()`, `readline()`, or
+        `readlines()` methods::
+
+            with open_zip(path) as f:
+                for line in f.readlines():
+                    print line
+    """
+    with zipfile.ZipFile(path) as z:
+        with z.open(z.namelist()[0]) as csv_file:
+            yield csv_file
+
+
+def partition_name(table_name, year):
+    """
+    Get the name of a table's partition for a given year.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        Name of the partitioned table.
+    year : int
+        The year of data held by the partition.
+
+    Returns
+    -------
+    str
+        The name of the partition, e.g. 'beneficiary_sample_2010'.
+    """
+    return "{0}_{1:d}".format(table_name, year)
+
+
+def create_partitions(cur, table_name):
+    """
+    Create a partition of a table for every year in db_years, using an open
+    cursor.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        An open cursor. The caller is responsible for committing.
+    table_name : str, unicode
+        Name of the partitioned table.
+    """
+    for year in dbconfig.db_years:
+        sql = ("CREATE TABLE {0} PARTITION OF {1} "
+               "FOR VALUES IN ({2:d});".format(
+                   partition_name(table_name, year), table_name, year))
+        cur.execute(sql)
+
+
+def table_exists(table_name):
+    """
+    Check whether a table exists in the database.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        Name of the table to look for.
+
+    Returns
+    -------
+    bool
+        True if the table exists.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = ("SELECT EXISTS (SELECT 1 FROM information_schema.tables "
+               "WHERE table_name = %s);")
+        cur.execute(sql, (table_name, ))
+        result = cur.fetchone()
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+    return result[0]
+
+
+def create_manifest_table():
+    """
+    Create the load manifest table given by MANIFEST_TABLE, if needed.
+
+    The manifest holds one row per source file loaded into a table, with the
+    file's checksum, the number of rows loaded from it, and its load status.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = ("CREATE TABLE IF NOT EXISTS {0} ("
+               "table_name VARCHAR(64), "
+               "file_name VARCHAR(128), "
+               "checksum CHAR(64), "
+               "row_count INT, "
+               "status VARCHAR(16), "
+               "updated_at TIMESTAMP DEFAULT now(), "
+               "PRIMARY KEY (table_name, file_name)"
+               ");".format(MANIFEST_TABLE))
+        cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def clear_manifest(table_name=STAGING_TABLE):
+    """
+    Delete all manifest entries for a table.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        The table to delete manifest entries for. Defaults to STAGING_TABLE.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = "DELETE FROM {0} WHERE table_name = %s;".format(MANIFEST_TABLE)
+        cur.execute(sql, (table_name, ))
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def get_manifest(table_name=STAGING_TABLE):
+    """
+    Get the manifest entries for a table.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        The table to get manifest entries for. Defaults to STAGING_TABLE.
+
+    Returns
+    -------
+    dict
+        A dictionary keyed by source file name whose values are dictionaries
+        with keys 'checksum', 'row_count' and 'status'.
+    """
+    manifest = {}
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = ("SELECT file_name, checksum, row_count, status FROM {0} "
+               "WHERE table_name = %s;".format(MANIFEST_TABLE))
+        cur.execute(sql, (table_name, ))
+        for file_name, checksum, row_count, status in cur.fetchall():
+            manifest[file_name] = {
+                'checksum': checksum,
+                'row_count': row_count,
+                'status': status,
+            }
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+    return manifest
+
+
+def _record_manifest(cur, file_name, checksum, row_count, status):
+    """
+    Insert or replace a manifest entry using an open cursor.
+
+    The caller is responsible for committing, so the entry can be written in
+    the same transaction as the data it describes.
+    """
+    sql = ("DELETE FROM {0} WHERE table_name = %s AND file_name = %s;"
+           "".format(MANIFEST_TABLE))
+    cur.execute(sql, (STAGING_TABLE, file_name))
+    sql = ("INSERT INTO {0} (table_name, file_name, checksum, row_count, "
+           "status) VALUES (%s, %s, %s, %s, %s);".format(MANIFEST_TABLE))
+    cur.execute(sql, (STAGING_TABLE, file_name, checksum, row_count, status))
+
+
+def create_version_table():
+    """
+    Create the dataset version table given by VERSION_TABLE, if needed.
+
+    The version of a table is bumped every time a new load is swapped in, so
+    the server can tell when the data it has cached results for has changed.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = ("CREATE TABLE IF NOT EXISTS {0} ("
+               "table_name VARCHAR(64) PRIMARY KEY, "
+               "version INT, "
+               "swapped_at TIMESTAMP DEFAULT now()"
+               ");".format(VERSION_TABLE))
+        cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def get_dataset_version():
+    """
+    Get the version of the live table in VERSION_TABLE.
+
+    Returns
+    -------
+    int
+        The dataset version, or None if the table has never been swapped in.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = "SELECT version FROM {0} WHERE table_name = %s;".format(
+            VERSION_TABLE)
+        cur.execute(sql, (TABLE_NAME, ))
+        result = cur.fetchone()
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+    if result is None:
+        return None
+    return result[0]
 
 
 def drop_table():
     """
-    Drop the table specified by TABLE_NAME.
+    Drop the table specified by STAGING_TABLE.
     """
     con, cur = cursor_connect(db_dsn)
     try:
-        sql = "DROP TABLE IF EXISTS {0};".format(TABLE_NAME)
+        drop_summaries(cur, STAGING_TABLE)
+        sql = "DROP TABLE IF EXISTS {0};".format(STAGING_TABLE)
         cur.execute(sql)
     except psycopg2.Error:
         raise
@@ -141,7 +594,8 @@ def drop_table():
 
 def create_table():
     """
-    Create the table given by TABLE_NAME.
+    Create the table given by STAGING_TABLE, with the columns in the schema
+    registry, partitioned by year.
     """
     con, cur = cursor_connect(db_dsn)
     # Create new column types, like factors in R, to hold sex and race.
@@ -162,41 +616,41 @@ def create_table():
                 con.close()
                 raise
     try:
-        sql = ("CREATE TABLE {0} ("
-               "id CHAR(16) UNIQUE, "
-               "dob CHAR(8), "  # These are converted to DATE later
-               "dod CHAR(8), "  # These are converted to DATE later
-               "sex sex, "
-               "race race, "
-               "end_stage_renal_disease BOOLEAN, "
-               "state VARCHAR(4), "
-               "county_code INT, "
-               "part_a_coverage_months INT, "
-               "part_b_coverage_months INT, "
-               "hmo_coverage_months INT, "
-               "part_d_coverage_months INT, "
-               "alzheimers_related_senile BOOLEAN, "
-               "heart_failure BOOLEAN, "
-               "chronic_kidney BOOLEAN, "
-               "cancer BOOLEAN, "
-               "chronic_obstructive_pulmonary BOOLEAN, "
-               "depression BOOLEAN, "
-               "diabetes BOOLEAN, "
-               "ischemic_heart BOOLEAN, "
-               "osteoporosis BOOLEAN, "
-               "rheumatoid_osteo_arthritis BOOLEAN, "
-               "stroke_ischemic_attack BOOLEAN, "
-               "inpatient_reimbursement INT, "
-               "inpatient_beneficiary_responsibility INT, "
-               "inpatient_primary_payer_reimbursement INT, "
-               "outpatient_reimbursement INT, "
-               "outpatient_beneficiary_responsibility INT, "
-               "outpatient_primary_payer_reimbursement INT, "
-               "carrier_reimbursement INT, "
-               "beneficiary_responsibility INT, "
-               "primary_payer_reimbursement INT"
-               ");".format(TABLE_NAME))
+        columns = ", ".join(column.definition()
+                            for column in schema.COLUMNS.values())
+        sql = ("CREATE TABLE {0} ({1}, UNIQUE (id, year)) "
+               "PARTITION BY LIST (year);".format(STAGING_TABLE, columns))
+        cur.execute(sql)
+        create_partitions(cur, STAGING_TABLE)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def copy_live_table():
+    """
+    Copy the live table given by TABLE_NAME and its manifest entries into a new
+    staging table, so new files can be appended without reloading it.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        # Secondary indexes are rebuilt by create_indexes() after the load
+        sql = ("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) "
+               "PARTITION BY LIST (year);".format(STAGING_TABLE, TABLE_NAME))
+        cur.execute(sql)
+        create_partitions(cur, STAGING_TABLE)
+        sql = "INSERT INTO {0} SELECT * FROM {1};".format(
+            STAGING_TABLE, TABLE_NAME)
         cur.execute(sql)
+        sql = "ALTER TABLE {0} ADD UNIQUE (id, year);".format(STAGING_TABLE)
+        cur.execute(sql)
+        sql = ("INSERT INTO {0} (table_name, file_name, checksum, row_count, "
+               "status) SELECT %s, file_name, checksum, row_count, status "
+               "FROM {0} WHERE table_name = %s;".format(MANIFEST_TABLE))
+        cur.execute(sql, (STAGING_TABLE, TABLE_NAME))
     except psycopg2.Error:
         raise
     else:
@@ -205,22 +659,40 @@ def create_table():
         con.close()
 
 
-def load_csv(csv_file):
+def load_csv(csv_file, year, file_name, checksum, row_count):
     """
-    Load data from a CSV file or file-like object into the database.
+    Load data from a prepared CSV file into the database.
+
+    The rows and the manifest entry marking the source file as loaded are
+    committed in a single transaction, so a crash never leaves a file half
+    loaded. If the load fails the source file is marked as 'failed'.
 
     Parameters
     ----------
     csv_file : str, unicode
-        A file of file-like object returned from download_zip(). The file must
-        have both `read()` and `readline()` methods.
-
+        Path to a prepared CSV file returned from prep_csv().
+    year : int
+        The year of data in the CSV file. Rows are copied straight into that
+        year's partition.
+    file_name : str, unicode
+        Name of the source .zip file the CSV was prepared from.
+    checksum : str, unicode
+        Checksum of the source .zip file.
+    row_count : int
+        Number of rows in the prepared CSV file.
     """
     con, cur = cursor_connect(db_dsn)
     try:
         with open(csv_file, 'r') as f:
-            cur.copy_from(f, TABLE_NAME, sep=',', null='')
+            cur.copy_from(f, partition_name(STAGING_TABLE, year), sep=',',
+                          null='')
+        _record_manifest(cur, file_name, checksum, row_count, 'loaded')
     except psycopg2.Error:
+        con.rollback()
+        _record_manifest(cur, file_name, checksum, None, 'failed')
+        con.commit()
+        cur.close()
+        con.close()
         raise
     else:
         con.commit()
@@ -228,35 +700,36 @@ def load_csv(csv_file):
         con.close()
 
 
-def prep_csv(csv_file):
+def prep_csv(csv_file, year, stats=None):
     """
     Modifies the CMS Medicare data to get it ready to load in the DB.
 
     Important modifications are transforming character columns to 0 and 1 for
-    import into BOOLEAN Postgres columns.
+    import into BOOLEAN Postgres columns, and adding the year of the data as
+    the first column.
 
     Parameters
     ----------
     csv_file : zipfile.ZipExtFile
-        A CSV-like object returned from download_zip().
+        A CSV-like object returned from open_zip().
+    year : int
+        The year of data in the file.
+    stats : core.instrumentation.StageStats
+        Optional stage counters to add the rows and bytes written to.
 
     Returns
     -------
-    str
-        Path to a prepared CSV file on disk.
-    """
-    states = ('AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC',
-              'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY',
-              'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT',
-              'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH',
-              'OK', 'OR', 'PA', '__', 'RI', 'SC', 'SD', 'TN', 'TX',
-              'UT', 'VT', '__', 'VA', 'WA', 'WV', 'WI', 'WY', 'Othr')
+    (str, int)
+        A tuple of (path to a prepared CSV file on disk, number of rows
+        written).
+    """
     states_map = {}
-    for i, val in enumerate(states):
+    for i, val in enumerate(STATES):
         states_map[i + 1] = val
     prepped_filename = 'prepped_medicare.csv'
+    num_rows = 0
     reader = csv.reader(csv_file)
-    with open(prepped_filename, 'a') as f:
+    with open(prepped_filename, 'w') as f:
         writer = csv.writer(f)
         for row in reader:
             # Transform state
@@ -285,8 +758,14 @@ def prep_csv(csv_file):
             # Transform strings to floats to ints
             for i in range(23, 32):
                 row[i] = str(int(float(row[i]))).encode('ascii')
-            writer.writerow(row)
-    return prepped_filename
+            writer.writerow([str(year).encode('ascii')] + row)
+            num_rows += 1
+            if stats is not None and num_rows % 10000 == 0:
+                stats.add(rows=10000)
+    if stats is not None:
+        stats.add(rows=num_rows % 10000,
+                  nbytes=os.path.getsize(prepped_filename))
+    return prepped_filename, num_rows
 
 
 def alter_col_types():
@@ -294,19 +773,22 @@ def alter_col_types():
     Alter column types of the table to better suit the data.
 
     For example, convert the character-represented-dates to type DATE.
+    Columns that have already been converted by an earlier load are skipped.
     """
     con, cur = cursor_connect(db_dsn)
     try:
-        # Get column names so you can index the 2th and 3th columns
-        sql = "SELECT * FROM {0} LIMIT 0;".format(TABLE_NAME)
-        cur.execute(sql)
-        colnames = [desc[0] for desc in cur.description]
-        cols = (colnames[1], colnames[2])  # DO-Birth and DO-Death
-        for col in cols:
+        for col in schema.columns("date"):
+            sql = """
+            SELECT data_type FROM information_schema.columns
+            WHERE table_name = %s AND column_name = %s;
+            """
+            cur.execute(sql, (STAGING_TABLE, col))
+            if cur.fetchone()[0] == 'date':
+                continue
             sql = """
             ALTER TABLE {0} ALTER COLUMN {1} TYPE DATE
             USING to_date({1}, 'YYYYMMDD');
-            """.format(TABLE_NAME, col)
+            """.format(STAGING_TABLE, col)
             cur.execute(sql)
     except psycopg2.Error:
         raise
@@ -316,26 +798,613 @@ def alter_col_types():
         con.close()
 
 
-def verify_data_load():
+def verify_data_load(full_counts=True):
     """
     Verify that all the data was loaded into the DB.
+
+    Each year of the table must hold exactly the number of rows recorded in
+    the load manifest and, once every file for that year in DATA_FILES is
+    loaded, the number of rows in the full CMS sample for that year.
+
+    Parameters
+    ----------
+    full_counts : bool
+        If False, don't check against the number of rows in the full CMS
+        sample, e.g. for synthetic data.
     """
     con, cur = cursor_connect(db_dsn)
     try:
-        sql = "SELECT COUNT(*) FROM {0}".format(TABLE_NAME)
+        sql = "SELECT year, COUNT(*) FROM {0} GROUP BY year;".format(
+            STAGING_TABLE)
         cur.execute(sql)
+        num_rows = dict(cur.fetchall())
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+    file_years = dict((uri.split('/')[-1], year) for year, uri in DATA_FILES)
+    manifest = get_manifest()
+    for year in dbconfig.db_years:
+        loaded = [v for k, v in manifest.items()
+                  if file_years.get(k) == year and v['status'] == 'loaded']
+        manifest_row_count = sum(v['row_count'] for v in loaded)
+        year_rows = num_rows.get(year, 0)
+        if year_rows != manifest_row_count:
+            raise AssertionError(
+                "{0} rows in DB for {1}. Manifest records {2}".format(
+                    year_rows, year, manifest_row_count))
+        num_files = len([y for y in file_years.values() if y == year])
+        if full_counts and len(loaded) == num_files:
+            expected_row_count = EXPECTED_ROW_COUNTS[year]
+            if year_rows != expected_row_count:
+                raise AssertionError(
+                    "{0} rows in DB for {1}. Should be {2}".format(
+                        year_rows, year, expected_row_count))
+    print("Data load complete.")
+
+
+def index_name(name):
+    """
+    Get the full name of an index in db_indexes on the table STAGING_TABLE.
+
+    Parameters
+    ----------
+    name : str, unicode
+        The name of the index in db_indexes.
+
+    Returns
+    -------
+    str
+        The name of the index in the database.
+    """
+    return "{0}_{1}_idx".format(STAGING_TABLE, name)
+
+
+def create_indexes():
+    """
+    Create the indexes given in db_indexes on the table STAGING_TABLE.
+
+    Indexes that already exist, e.g. from an interrupted load, are rebuilt.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        for name, columns, where in dbconfig.db_indexes:
+            sql = "DROP INDEX IF EXISTS {0};".format(index_name(name))
+            cur.execute(sql)
+            sql = "CREATE INDEX {0} ON {1} ({2})".format(
+                index_name(name), STAGING_TABLE, columns)
+            if where is not None:
+                sql += " WHERE {0}".format(where)
+            cur.execute(sql + ";")
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def cluster_table():
+    """
+    Physically order the table STAGING_TABLE by state, using the 'state' index
+    in db_indexes, so per-state queries read fewer pages.
+
+    Partitioned tables can't be clustered directly, so each partition is
+    clustered using its own copy of the index.
+    """
+    if ("state", "state", None) not in dbconfig.db_indexes:
+        raise ValueError("Clustering needs the 'state' index in db_indexes.")
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = """
+        SELECT i.indrelid::regclass::text, i.indexrelid::regclass::text
+        FROM pg_inherits h JOIN pg_index i ON i.indexrelid = h.inhrelid
+        WHERE h.inhparent = %s::regclass;
+        """
+        cur.execute(sql, (index_name("state"), ))
+        for partition, partition_index in cur.fetchall():
+            sql = "CLUSTER {0} USING {1};".format(partition, partition_index)
+            cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def time_queries(table_name=STAGING_TABLE, index_scans=True):
+    """
+    Time a query of each shape served by the API against a table.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        Name of the table or view to query.
+    index_scans : bool
+        If False, make Postgres scan the whole table for every query, even if
+        it has a useful index.
+
+    Returns
+    -------
+    OrderedDict
+        A dictionary of query names from BENCHMARK_QUERIES and the time it
+        took to run them, in seconds.
+    """
+    timings = OrderedDict()
+    con, cur = cursor_connect(db_dsn)
+    try:
+        if not index_scans:
+            for setting in ("indexscan", "indexonlyscan", "bitmapscan"):
+                cur.execute("SET enable_{0} = off;".format(setting))
+        years = queries.year_filter(dbconfig.db_default_year)
+        for name, query, col in BENCHMARK_QUERIES:
+            start = time.time()
+            cur.execute(query.format(col=col, table=table_name,
+                                     years=years))
+            cur.fetchall()
+            timings[name] = time.time() - start
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+    return timings
+
+
+def print_timings(before, after):
+    """
+    Print query timings from before and after optimizing the table.
+
+    Parameters
+    ----------
+    before : OrderedDict
+        Query timings returned from time_queries() before optimizing.
+    after : OrderedDict
+        Query timings returned from time_queries() after optimizing.
+    """
+    print("Query timings (before -> after):")
+    for name in before:
+        print("  {0}: {1:.3f}s -> {2:.3f}s ({3:.1f}x)".format(
+              name, before[name], after[name],
+              before[name] / max(after[name], 1e-6)))
+
+
+def analyze_table():
+    """
+    Refresh the planner statistics of the table given by STAGING_TABLE.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = "ANALYZE {0};".format(STAGING_TABLE)
+        cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+
+
+def summary_view_sql(table_name):
+    """
+    Get the SQL to create each summary view of a table.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        Name of the table to summarize.
+
+    Returns
+    -------
+    OrderedDict
+        A dictionary of view names from queries.SUMMARY_VIEWS and tuples of
+        (CREATE MATERIALIZED VIEW statement, columns of the view's unique
+        index).
+    """
+    views = OrderedDict()
+    # Count of each value of each column, from a single scan of the table.
+    # Each grouping set's rows are then unpivoted into (col, value) pairs,
+    # picking out the column they were grouped by from the GROUPING() bitmask,
+    # which has a bit set for each column not grouped by.
+    cols = dbconfig.db_summary_count_columns
+    all_bits = (1 << len(cols)) - 1
+    values = ", ".join(
+        "('{0}', g.{0}, {1:d})".format(
+            col, all_bits ^ (1 << (len(cols) - 1 - i)))
+        for i, col in enumerate(cols))
+    views["counts"] = (
+        "SELECT g.year, v.col, v.value, g.num FROM ("
+        "SELECT year, {0}, COUNT(*) AS num, GROUPING({1}) AS grouping "
+        "FROM {2} GROUP BY year, GROUPING SETS ({1})) AS g, "
+        "LATERAL (VALUES {3}) AS v (col, value, grouping) "
+        "WHERE v.grouping = g.grouping".format(
+            ", ".join("{0}::text AS {0}".format(col) for col in cols),
+            ", ".join(cols), table_name, values),
+        "year, col, value")
+    # Sums and counts rather than averages, so years can be combined
+    sums = ", ".join("SUM({0}) AS {0}_sum, COUNT({0}) AS {0}_count".format(col)
+                     for col in dbconfig.db_summary_average_columns)
+    views["averages"] = (
+        "SELECT year, {0} FROM {1} GROUP BY year".format(sums, table_name),
+        "year")
+    counts = ", ".join("COUNT(*) FILTER (WHERE {0}) AS {0}".format(col)
+                       for col in dbconfig.db_disease_columns)
+    views["state_totals"] = (
+        "SELECT year, state, COUNT(*) AS claims, {0} FROM {1} "
+        "GROUP BY year, state".format(counts, table_name),
+        "year, state")
+    for view, (sql, key) in views.items():
+        name = queries.summary_view_name(table_name, view)
+        views[view] = ("CREATE MATERIALIZED VIEW {0} AS {1};".format(
+            name, sql), key)
+    return views
+
+
+def create_summaries(table_name=STAGING_TABLE, refresh=True):
+    """
+    Build the summary views of a table, which the API reads instead of the
+    table wherever they can answer a query.
+
+    Views that don't exist are created. Views that already exist, e.g. from an
+    interrupted load, are refreshed concurrently, so queries against them
+    aren't blocked while they're rebuilt.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        Name of the table to summarize.
+    refresh : bool
+        If False, leave views that already exist as they are.
+    """
+    con, cur = cursor_connect(db_dsn)
+    # REFRESH ... CONCURRENTLY can't run inside a transaction block
+    con.autocommit = True
+    try:
+        for view, (sql, key) in summary_view_sql(table_name).items():
+            name = queries.summary_view_name(table_name, view)
+            cur.execute("SELECT to_regclass(%s);", (name, ))
+            if cur.fetchone()[0] is None:
+                cur.execute(sql)
+                sql = "CREATE UNIQUE INDEX {0}_idx ON {0} ({1});".format(
+                    name, key)
+                cur.execute(sql)
+            elif refresh:
+                sql = "REFRESH MATERIALIZED VIEW CONCURRENTLY {0};".format(
+                    name)
+                cur.execute(sql)
+            sql = "ANALYZE {0};".format(name)
+            cur.execute(sql)
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+
+
+def drop_summaries(cur, table_name):
+    """
+    Drop the summary views of a table, so the table itself can be dropped.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        Cursor to drop the views with, as part of its transaction.
+    table_name : str, unicode
+        Name of the summarized table.
+    """
+    for view in queries.SUMMARY_VIEWS:
+        sql = "DROP MATERIALIZED VIEW IF EXISTS {0};".format(
+            queries.summary_view_name(table_name, view))
+        cur.execute(sql)
+
+
+def swap_tables():
+    """
+    Replace the live table with the staging table in a single transaction.
+
+    The old table and its summary views are dropped, the staging table, its
+    partitions, its summary views and their indexes are renamed to take its
+    place, its manifest entries are moved over,
+    and its version in VERSION_TABLE is bumped. Queries against TABLE_NAME wait
+    on the swap and then see the new table, so they never see an empty or
+    partial table.
+
+    Returns
+    -------
+    int
+        The new dataset version.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        drop_summaries(cur, TABLE_NAME)
+        sql = "DROP TABLE IF EXISTS {0};".format(TABLE_NAME)
+        cur.execute(sql)
+        # Also drop any stray tables in the way of the partitions, like the
+        # unpartitioned beneficiary_sample_2010 table of older versions
+        for year in dbconfig.db_years:
+            sql = "DROP TABLE IF EXISTS {0};".format(
+                partition_name(TABLE_NAME, year))
+            cur.execute(sql)
+        sql = "ALTER TABLE {0} RENAME TO {1};".format(STAGING_TABLE,
+                                                      TABLE_NAME)
+        cur.execute(sql)
+        sql = """
+        SELECT inhrelid::regclass::text FROM pg_inherits
+        WHERE inhparent = %s::regclass;
+        """
+        cur.execute(sql, (TABLE_NAME, ))
+        partitions = [row[0] for row in cur.fetchall()]
+        for partition in partitions:
+            sql = "ALTER TABLE {0} RENAME TO {1};".format(
+                partition, partition.replace(STAGING_TABLE, TABLE_NAME, 1))
+            cur.execute(sql)
+        views = []
+        for view in queries.SUMMARY_VIEWS:
+            view_name = queries.summary_view_name(TABLE_NAME, view)
+            sql = "ALTER MATERIALIZED VIEW IF EXISTS {0} RENAME TO {1};"
+            cur.execute(sql.format(
+                queries.summary_view_name(STAGING_TABLE, view), view_name))
+            views.append(view_name)
+        # Rename indexes too, so the next staging table can reuse their names
+        sql = "SELECT indexname FROM pg_indexes WHERE tablename = ANY(%s);"
+        tables = [TABLE_NAME] + views + [
+            partition.replace(STAGING_TABLE, TABLE_NAME, 1)
+            for partition in partitions]
+        cur.execute(sql, (tables, ))
+        for row in cur.fetchall():
+            index_name = row[0]
+            if index_name.startswith(STAGING_TABLE):
+                sql = "ALTER INDEX {0} RENAME TO {1};".format(
+                    index_name,
+                    index_name.replace(STAGING_TABLE, TABLE_NAME, 1))
+                cur.execute(sql)
+        sql = "DELETE FROM {0} WHERE table_name = %s;".format(MANIFEST_TABLE)
+        cur.execute(sql, (TABLE_NAME, ))
+        sql = ("UPDATE {0} SET table_name = %s "
+               "WHERE table_name = %s;".format(MANIFEST_TABLE))
+        cur.execute(sql, (TABLE_NAME, STAGING_TABLE))
+        sql = ("UPDATE {0} SET version = version + 1, swapped_at = now() "
+               "WHERE table_name = %s RETURNING version;".format(
+                   VERSION_TABLE))
+        cur.execute(sql, (TABLE_NAME, ))
         result = cur.fetchone()
-        num_rows = result[0]
+        if result is None:
+            sql = ("INSERT INTO {0} (table_name, version) VALUES (%s, 1) "
+                   "RETURNING version;".format(VERSION_TABLE))
+            cur.execute(sql, (TABLE_NAME, ))
+            result = cur.fetchone()
+        version = result[0]
+    except psycopg2.Error:
+        con.rollback()
+        cur.close()
+        con.close()
+        raise
+    else:
+        con.commit()
+        cur.close()
+        con.close()
+    return version
+
+
+def compact_columns(pack_flags=False):
+    """
+    Get the columns of the compact layout of the table.
+
+    Columns take the narrower `compact_type` from the schema registry, states
+    are replaced by their code in STATE_CODES_TABLE, and the disease flags are
+    optionally packed into a single 'diseases' column, with the flag of the
+    i-th boolean column in bit i. Columns are ordered from widest to narrowest
+    alignment so that no space is lost to padding between them.
+
+    Parameters
+    ----------
+    pack_flags : bool
+        If True, pack the disease flags.
+
+    Returns
+    -------
+    list
+        Tuples of (column name, type, expression computing it from a row `t`
+        of the table and its row `s` of STATE_CODES_TABLE).
+    """
+    columns = []
+    for name, column in schema.COLUMNS.items():
+        if name == "state":
+            columns.append(("state_code", column.compact_type, "s.code"))
+        elif column.role == "boolean" and pack_flags:
+            continue
+        else:
+            columns.append((name, column.compact_type, "t." + name))
+    if pack_flags:
+        bits = " | ".join(
+            "(t.{0}::int << {1:d})".format(col, i)
+            for i, col in enumerate(schema.columns("boolean")))
+        columns.append(("diseases", "SMALLINT",
+                        "({0})::smallint".format(bits)))
+    alignment = {"SMALLINT": 1, "BOOLEAN": 2}
+    columns.sort(key=lambda col: 3 if col[1].startswith("CHAR") else
+                 alignment.get(col[1].split()[0], 0))
+    return columns
+
+
+def create_compact_table(pack_flags=False):
+    """
+    Build COMPACT_TABLE, a copy of the live table in the compact layout, and
+    COMPACT_VIEW over it, which decodes it back into the live table's columns.
+
+    Parameters
+    ----------
+    pack_flags : bool
+        If True, pack the disease flags into a single integer column.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = "DROP VIEW IF EXISTS {0};".format(COMPACT_VIEW)
+        cur.execute(sql)
+        sql = "DROP TABLE IF EXISTS {0};".format(COMPACT_TABLE)
+        cur.execute(sql)
+        sql = ("CREATE TABLE IF NOT EXISTS {0} (code SMALLINT PRIMARY KEY, "
+               "state VARCHAR(4) UNIQUE NOT NULL);".format(STATE_CODES_TABLE))
+        cur.execute(sql)
+        for code, state in enumerate(STATES, 1):
+            if state != '__':
+                sql = ("INSERT INTO {0} (code, state) VALUES (%s, %s) "
+                       "ON CONFLICT DO NOTHING;".format(STATE_CODES_TABLE))
+                cur.execute(sql, (code, state))
+        columns = compact_columns(pack_flags)
+        sql = "CREATE TABLE {0} ({1}) PARTITION BY LIST (year);".format(
+            COMPACT_TABLE, ", ".join("{0} {1}".format(name, sql_type)
+                                     for name, sql_type, expr in columns))
+        cur.execute(sql)
+        create_partitions(cur, COMPACT_TABLE)
+        sql = ("INSERT INTO {0} ({1}) SELECT {2} FROM {3} AS t "
+               "LEFT JOIN {4} AS s ON s.state = t.state;".format(
+                   COMPACT_TABLE,
+                   ", ".join(name for name, sql_type, expr in columns),
+                   ", ".join(expr for name, sql_type, expr in columns),
+                   TABLE_NAME, STATE_CODES_TABLE))
+        cur.execute(sql)
+        # The view has the live table's columns, in the same order
+        flags = schema.columns("boolean")
+        selects = []
+        for name, column in schema.COLUMNS.items():
+            if name == "state":
+                selects.append("s.state")
+            elif column.role == "boolean" and pack_flags:
+                selects.append("(c.diseases & {0:d}) <> 0 AS {1}".format(
+                    1 << flags.index(name), name))
+            else:
+                selects.append("c." + name)
+        sql = ("CREATE VIEW {0} AS SELECT {1} FROM {2} AS c "
+               "LEFT JOIN {3} AS s ON s.code = c.state_code;".format(
+                   COMPACT_VIEW, ", ".join(selects), COMPACT_TABLE,
+                   STATE_CODES_TABLE))
+        cur.execute(sql)
+        sql = "ANALYZE {0};".format(COMPACT_TABLE)
+        cur.execute(sql)
     except psycopg2.Error:
         raise
     else:
+        con.commit()
         cur.close()
         con.close()
-        expected_row_count = 2255098
-        if num_rows != expected_row_count:
-            raise AssertionError("{0} rows in DB. Should be {1}".format(
-                                 num_rows, expected_row_count))
-        print("Data load complete.")
+
+
+def table_size(table_name):
+    """
+    Get the size of a partitioned table's data, not counting its indexes.
+
+    Parameters
+    ----------
+    table_name : str, unicode
+        Name of the table.
+
+    Returns
+    -------
+    int
+        Size of all of the table's partitions, in bytes.
+    """
+    con, cur = cursor_connect(db_dsn)
+    try:
+        sql = """
+        SELECT COALESCE(SUM(pg_table_size(inhrelid)), 0)::bigint
+        FROM pg_inherits WHERE inhparent = %s::regclass;
+        """
+        cur.execute(sql, (table_name, ))
+        result = cur.fetchone()
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+    return result[0]
+
+
+def compare_compact():
+    """
+    Compare the size of the live table and COMPACT_TABLE, and how long a full
+    scan for each query served by the API takes against each.
+
+    Returns
+    -------
+    dict
+        Sizes in bytes and query timings in seconds for the 'current' and
+        'compact' layouts.
+    """
+    sizes = OrderedDict([("current", table_size(TABLE_NAME)),
+                         ("compact", table_size(COMPACT_TABLE))])
+    timings = OrderedDict([
+        ("current", time_queries(TABLE_NAME, index_scans=False)),
+        ("compact", time_queries(COMPACT_VIEW, index_scans=False)),
+    ])
+    print("Table size (current -> compact): {0:,d} -> {1:,d} bytes "
+          "({2:.1f}x)".format(sizes["current"], sizes["compact"],
+                              sizes["current"] / max(sizes["compact"], 1)))
+    print("Full scan timings (current -> compact):")
+    for name in timings["current"]:
+        print("  {0}: {1:.3f}s -> {2:.3f}s ({3:.1f}x)".format(
+              name, timings["current"][name], timings["compact"][name],
+              timings["current"][name] / max(timings["compact"][name], 1e-6)))
+    return {'size_bytes': sizes, 'query_seconds': timings}
+
+
+def write_table_snapshot(path, stats=None):
+    """
+    Write a columnar snapshot of the live table, tagged with its version in
+    VERSION_TABLE.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path to write the snapshot to.
+    stats : instrumentation.StageStats
+        Optional stage counters to add the rows and bytes written to.
+    """
+    version = get_dataset_version()
+    con = psycopg2.connect(dsn=db_dsn)
+    try:
+        # Stream the rows with a server-side cursor instead of fetching the
+        # whole table into memory at once
+        cur = con.cursor("snapshot")
+        cur.itersize = 10000
+        sql = "SELECT {0} FROM {1};".format(", ".join(schema.COLUMNS),
+                                            TABLE_NAME)
+        cur.execute(sql)
+        num_rows = snapshot.write_snapshot(path, cur, version, TABLE_NAME)
+    except psycopg2.Error:
+        raise
+    else:
+        cur.close()
+        con.close()
+    if stats is not None:
+        stats.add(rows=num_rows, nbytes=os.path.getsize(path))
+
+
+def snapshot_version(path):
+    """
+    Get the dataset version of an existing snapshot.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path to the snapshot.
+
+    Returns
+    -------
+    int
+        The snapshot's dataset version, or None if there's no readable
+        snapshot at the path.
+    """
+    try:
+        existing = snapshot.Snapshot(path)
+    except (IOError, ValueError):
+        return None
+    version = existing.dataset_version
+    existing.close()
+    return version
+
 
 if __name__ == '__main__':
     # Create the database's DNS to connect with using psycopg2
@@ -349,27 +1418,156 @@ if __name__ == '__main__':
             os.remove(f)
     except:
         pass
-    # Delete the table and recreate it if it exists
-    print("Dropping table.")
-    drop_table()
-    print("Creating table.")
-    create_table()
-    # Download the data and load it into the DB
+    # Every run writes a report, including ones that fail or find nothing to
+    # load
+    report = LoadReport(args.progress)
+    data_files = [(year, uri) for year, uri in DATA_FILES
+                  if year in args.years]
     try:
-        for uri in DATA_FILES:
-            print("Downloading {0}".format(uri.split('/')[-1]))
-            medicare_csv = download_zip(uri)
-            headers = medicare_csv.readline().replace('"', "").split(",")
-            print("Downloaded CSV contains {0} headers.".format(len(headers)))
-            prepped_csv = prep_csv(medicare_csv)
-        print("Loading data into database '{0}' at '{1}'.".format(
-              args.dbname, args.host))
-        load_csv(prepped_csv)
+        create_manifest_table()
+        create_version_table()
+        # Build the new data in a staging table while the live table keeps
+        # serving. Start it from scratch if asked to or if there is no live
+        # table, resume it if an earlier load didn't finish, and otherwise
+        # start it from a copy of the live table so only new files need to be
+        # loaded.
+        live_manifest = get_manifest(TABLE_NAME)
+        if args.rebuild:
+            print("Dropping staging table.")
+            drop_table()
+            clear_manifest()
+            print("Creating staging table.")
+            create_table()
+        elif table_exists(STAGING_TABLE):
+            print("Resuming load into staging table.")
+        elif live_manifest and table_exists(TABLE_NAME):
+            loaded = [k for k, v in live_manifest.items()
+                      if v['status'] == 'loaded']
+            if (set(uri.split('/')[-1] for year, uri in data_files) <=
+                    set(loaded)):
+                print("All files are already loaded.")
+                # Summarize tables loaded before there were summary views
+                create_summaries(TABLE_NAME, refresh=False)
+                if args.compact:
+                    print("Building compact table.")
+                    with report.stage('compact'):
+                        create_compact_table(args.pack_flags)
+                    report.info['compact'] = compare_compact()
+                # Snapshot tables loaded before there were snapshots
+                if (args.snapshot and snapshot_version(args.snapshot) !=
+                        get_dataset_version()):
+                    print("Writing snapshot to {0}.".format(args.snapshot))
+                    with report.stage('snapshot') as stats:
+                        write_table_snapshot(args.snapshot, stats)
+                report.status = 'complete'
+                sys.exit(0)
+            print("Copying live table into staging table.")
+            with report.stage('copy_live'):
+                copy_live_table()
+        else:
+            print("Creating staging table.")
+            clear_manifest()
+            create_table()
+        manifest = get_manifest()
+        if not os.path.isdir(args.cache_dir):
+            os.makedirs(args.cache_dir)
+        # Get the data, from the cache if possible, and load it into the DB
+        # one file at a time
+        for file_num, (year, uri) in enumerate(data_files):
+            filename = uri.split('/')[-1]
+            entry = manifest.get(filename)
+            loaded = entry is not None and entry['status'] == 'loaded'
+            if (loaded and not args.synthetic and not os.path.isfile(
+                    os.path.join(args.cache_dir, filename))):
+                # Don't fetch a loaded file's archive just to check that it
+                # hasn't changed, e.g. when only new files are being appended
+                print("Skipping {0}, already loaded.".format(filename))
+                continue
+            if args.synthetic:
+                checksum = hashlib.sha256("synthetic-{0}-{1}".format(
+                    args.seed, args.synthetic)).hexdigest()
+            else:
+                with report.stage('fetch', filename) as stats:
+                    zip_path, checksum = fetch_zip(uri, args.cache_dir,
+                                                   args.offline)
+                    stats.add(nbytes=os.path.getsize(zip_path))
+            if loaded:
+                if entry['checksum'] == checksum:
+                    print("Skipping {0}, already loaded.".format(filename))
+                    continue
+                raise ValueError(
+                    "{0} has changed since it was loaded. "
+                    "Run with --rebuild to reload all files.".format(filename))
+            with report.stage('prep', filename) as stats:
+                if args.synthetic:
+                    # Stand in for the file with generated rows, with ids that
+                    # don't overlap those generated for other files
+                    medicare_csv = synthetic.csv_lines(
+                        args.synthetic, year, args.seed,
+                        start=file_num * args.synthetic, header=False)
+                    prepped_csv, num_rows = prep_csv(medicare_csv, year,
+                                                     stats)
+                else:
+                    with open_zip(zip_path) as medicare_csv:
+                        headers = medicare_csv.readline().replace(
+                            '"', "").split(",")
+                        print("{0} contains {1} headers.".format(
+                            filename, len(headers)))
+                        prepped_csv, num_rows = prep_csv(medicare_csv, year,
+                                                         stats)
+            print("Loading {0} rows into database '{1}' at '{2}'.".format(
+                  num_rows, args.dbname, args.host))
+            with report.stage('copy', filename) as stats:
+                load_csv(prepped_csv, year, filename, checksum, num_rows)
+                stats.add(rows=num_rows,
+                          nbytes=os.path.getsize(prepped_csv))
+            os.remove(prepped_csv)
         print("Altering columns.")
-        alter_col_types()
+        with report.stage('alter'):
+            alter_col_types()
         print("Verifying data load.")
-        verify_data_load()
+        with report.stage('verify'):
+            verify_data_load(full_counts=not args.synthetic)
+        print("Timing queries.")
+        with report.stage('time_queries_before'):
+            timings_before = time_queries()
+        print("Creating indexes.")
+        with report.stage('create_indexes'):
+            create_indexes()
+        if args.cluster:
+            print("Clustering table by state.")
+            with report.stage('cluster'):
+                cluster_table()
+        print("Analyzing table.")
+        with report.stage('analyze'):
+            analyze_table()
+        with report.stage('time_queries_after'):
+            timings_after = time_queries()
+        print("Building summary views.")
+        with report.stage('summaries'):
+            create_summaries()
+        print_timings(timings_before, timings_after)
+        report.info['query_seconds'] = {
+            'before': timings_before, 'after': timings_after}
+        print("Swapping staging table into place.")
+        with report.stage('swap'):
+            version = swap_tables()
+        print("Dataset version is now {0}.".format(version))
+        report.info['dataset_version'] = version
+        if args.compact:
+            print("Building compact table.")
+            with report.stage('compact'):
+                create_compact_table(args.pack_flags)
+            report.info['compact'] = compare_compact()
+        if args.snapshot:
+            print("Writing snapshot to {0}.".format(args.snapshot))
+            with report.stage('snapshot') as stats:
+                write_table_snapshot(args.snapshot, stats)
+        report.status = 'complete'
+    except SystemExit:
+        raise
     except:
+        report.status = 'failed'
         raise
     finally:
         try:
@@ -377,3 +1575,5 @@ if __name__ == '__main__':
             os.remove(prepped_csv)
         except:
             pass
+        print("Writing load report to {0}.".format(args.report))
+        report.write(args.report)
@@ -0,0 +1,310 @@
+"""Generate synthetic CMS Beneficiary Summary data for scale testing.
+
+Rows are written in the raw format of the CMS
+DE1_0_YYYY_Beneficiary_Summary_File_Sample_XX CSV files, so they can be fed to
+`prep_csv()` in data_loader.py exactly like the real data. Each column is drawn
+independently from a distribution close to its marginal distribution in the
+2010 sample, just like the columns of the CMS data itself.
+
+Generate 10 million rows to a file, or pass `--zip` to write an archive that
+can be put in the data loader's cache directory::
+
+    python synthetic.py --rows 10000000 --seed 1 --out synthetic.csv
+
+To load synthetic data instead of the CMS files, run the data loader with
+`--synthetic ROWS_PER_FILE`.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import bisect
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+HEADERS = [
+    "DESYNPUF_ID", "BENE_BIRTH_DT", "BENE_DEATH_DT", "BENE_SEX_IDENT_CD",
+    "BENE_RACE_CD", "BENE_ESRD_IND", "SP_STATE_CODE", "BENE_COUNTY_CD",
+    "BENE_HI_CVRAGE_TOT_MONS", "BENE_SMI_CVRAGE_TOT_MONS",
+    "BENE_HMO_CVRAGE_TOT_MONS", "PLAN_CVRG_MOS_NUM", "SP_ALZHDMTA", "SP_CHF",
+    "SP_CHRNKIDN", "SP_CNCR", "SP_COPD", "SP_DEPRESSN", "SP_DIABETES",
+    "SP_ISCHMCHT", "SP_OSTEOPRS", "SP_RA_OA", "SP_STRKETIA", "MEDREIMB_IP",
+    "BENRES_IP", "PPPYMT_IP", "MEDREIMB_OP", "BENRES_OP", "PPPYMT_OP",
+    "MEDREIMB_CAR", "BENRES_CAR", "PPPYMT_CAR",
+]
+
+# Percent of beneficiaries in each SP_STATE_CODE. Codes 40 and 48 are not used.
+STATE_WEIGHTS = {
+    1: 1.8, 2: 0.2, 3: 1.9, 4: 1.1, 5: 9.3, 6: 1.3, 7: 1.2, 8: 0.3, 9: 0.2,
+    10: 7.4, 11: 2.6, 12: 0.4, 13: 0.5, 14: 4.0, 15: 2.1, 16: 1.1, 17: 0.9,
+    18: 1.6, 19: 1.5, 20: 0.5, 21: 1.6, 22: 2.2, 23: 3.4, 24: 1.6, 25: 1.0,
+    26: 2.1, 27: 0.4, 28: 0.6, 29: 0.8, 30: 0.5, 31: 2.8, 32: 0.6, 33: 6.4,
+    34: 3.0, 35: 0.2, 36: 4.0, 37: 1.3, 38: 1.3, 39: 4.7, 41: 0.4, 42: 1.6,
+    43: 0.3, 44: 2.2, 45: 6.6, 46: 0.6, 47: 0.2, 49: 2.5, 50: 2.1, 51: 0.8,
+    52: 1.9, 53: 0.2, 54: 0.9,
+}
+# Percent of beneficiaries by BENE_SEX_IDENT_CD and BENE_RACE_CD
+SEX_WEIGHTS = {'1': 44.6, '2': 55.4}
+RACE_WEIGHTS = {'1': 83.6, '2': 10.5, '3': 2.9, '5': 3.0}
+# Fraction of beneficiaries with end stage renal disease
+ESRD_RATE = 0.073
+# Fraction of beneficiaries with each chronic condition, SP_ALZHDMTA through
+# SP_STRKETIA
+CONDITION_RATES = [
+    0.19, 0.28, 0.16, 0.07, 0.13, 0.21, 0.38, 0.42, 0.17, 0.15, 0.04,
+]
+# Fraction of beneficiaries who died during the year
+DEATH_RATE = 0.015
+# For Part A, Part B, HMO and Part D coverage months, the fraction of
+# beneficiaries covered for all 12 months and for 0 months. The rest are
+# covered for 1 to 11 months.
+COVERAGE_RATES = [
+    (0.95, 0.02),
+    (0.91, 0.05),
+    (0.28, 0.62),
+    (0.58, 0.33),
+]
+# For each payment column MEDREIMB_IP through PPPYMT_CAR, the fraction of
+# beneficiaries with a nonzero amount and the mean and standard deviation of
+# the log of nonzero amounts. Amounts are multiples of $10.
+PAYMENT_DISTRIBUTIONS = [
+    (0.16, 8.9, 0.9),
+    (0.14, 6.9, 0.3),
+    (0.01, 8.2, 1.0),
+    (0.62, 5.9, 1.3),
+    (0.50, 4.3, 1.2),
+    (0.03, 5.3, 1.3),
+    (0.89, 6.8, 1.2),
+    (0.85, 5.2, 1.2),
+    (0.02, 4.8, 1.3),
+]
+
+# Odd multiplier used to scramble row numbers into unique 64-bit ids
+ID_MULTIPLIER = 0x9E3779B97F4A7C15
+ID_MASK = (1 << 64) - 1
+
+
+def _cumulative(weights):
+    """
+    Turn a dictionary of weights into keys and cumulative probabilities for
+    sampling with `bisect`.
+    """
+    keys = sorted(weights)
+    total = sum(weights.values())
+    cumulative = []
+    running = 0
+    for key in keys:
+        running += weights[key]
+        cumulative.append(running / total)
+    return [str(key).encode('ascii') for key in keys], cumulative
+
+
+def generate_rows(num_rows, year=2010, seed=0, start=0, chunk_size=10000):
+    """
+    Generate synthetic beneficiary rows in the raw CMS format.
+
+    Rows are generated in chunks, so any number of rows can be streamed in
+    constant memory.
+
+    Parameters
+    ----------
+    num_rows : int
+        Number of rows to generate.
+    year : int
+        Year of the data. Birth and death dates are relative to it.
+    seed : int
+        Random seed. The same seed, year and start always generate the same
+        rows.
+    start : int
+        Number of the first row. Ids are unique across rows numbers, so
+        generate files to load together with non-overlapping row numbers.
+    chunk_size : int
+        Number of rows per chunk.
+
+    Returns
+    -------
+    generator
+        A generator of lists of rows, each row a tuple of strings.
+    """
+    rng = random.Random("{0}-{1}-{2}".format(seed, year, start))
+    r = rng.random
+    gauss = rng.gauss
+    exp = math.exp
+    bisect_right = bisect.bisect_right
+    states, state_cum = _cumulative(STATE_WEIGHTS)
+    sexes, sex_cum = _cumulative(SEX_WEIGHTS)
+    races, race_cum = _cumulative(RACE_WEIGHTS)
+    birth_years = [str(year - 100 + i).encode('ascii') for i in range(36)]
+    month_days = [b'%02d01' % i for i in range(1, 13)]
+    death_dates = [str(year).encode('ascii') + md for md in month_days]
+    counties = [b'%03d' % i for i in range(1000)]
+    months = [str(i).encode('ascii') for i in range(13)]
+    for chunk_start in range(start, start + num_rows, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, start + num_rows)
+        n = chunk_end - chunk_start
+        # Build the chunk a column at a time, which is much faster than
+        # building it a row at a time
+        cols = [
+            [b'%016X' % ((i * ID_MULTIPLIER) & ID_MASK)
+             for i in range(chunk_start, chunk_end)],
+            [birth_years[int(35 * r() ** 0.6)] + month_days[int(12 * r())]
+             for _ in range(n)],
+            [death_dates[int(12 * r())] if r() < DEATH_RATE else b''
+             for _ in range(n)],
+            [sexes[bisect_right(sex_cum, r())] for _ in range(n)],
+            [races[bisect_right(race_cum, r())] for _ in range(n)],
+            [b'Y' if r() < ESRD_RATE else b'0' for _ in range(n)],
+            [states[bisect_right(state_cum, r())] for _ in range(n)],
+            [counties[int(1000 * r())] for _ in range(n)],
+        ]
+        for i, (full, none) in enumerate(COVERAGE_RATES):
+            # HMO coverage months are zero-padded in the CMS files
+            zero = b'00' if i == 2 else b'0'
+            partial = full + none
+            cols.append([
+                months[12] if x < full else
+                zero if x < partial else
+                months[1 + int(11 * (x - partial) / (1 - partial))]
+                for x in (r() for _ in range(n))])
+        for rate in CONDITION_RATES:
+            cols.append([b'1' if r() < rate else b'2' for _ in range(n)])
+        for p, mu, sigma in PAYMENT_DISTRIBUTIONS:
+            cols.append([
+                b'%d.00' % (int(exp(gauss(mu, sigma)) / 10 + 1) * 10)
+                if r() < p else b'0.00' for _ in range(n)])
+        yield list(zip(*cols))
+
+
+def header_line():
+    """
+    Get the header line of the CMS CSV files.
+
+    Returns
+    -------
+    str
+        The quoted column names, ending in a newline.
+    """
+    return b','.join(b'"' + h.encode('ascii') + b'"' for h in HEADERS) + b'\n'
+
+
+def csv_lines(num_rows, year=2010, seed=0, start=0, header=True):
+    """
+    Generate synthetic beneficiary data as lines of CSV.
+
+    This can be passed to `prep_csv()` in place of a file from `open_zip()`.
+
+    Parameters
+    ----------
+    num_rows : int
+        Number of rows to generate.
+    year : int
+        Year of the data.
+    seed : int
+        Random seed.
+    start : int
+        Number of the first row.
+    header : bool
+        If True, the first line is the CMS header line.
+
+    Returns
+    -------
+    generator
+        A generator of CSV lines, each ending in a newline.
+    """
+    if header:
+        yield header_line()
+    for rows in generate_rows(num_rows, year, seed, start):
+        for row in rows:
+            yield b','.join(row) + b'\n'
+
+
+def write_csv(f, num_rows, year=2010, seed=0, start=0):
+    """
+    Write synthetic beneficiary data to a CSV file, with the CMS header line.
+
+    Parameters
+    ----------
+    f : file
+        A file opened for writing in binary mode.
+    num_rows : int
+        Number of rows to generate.
+    year : int
+        Year of the data.
+    seed : int
+        Random seed.
+    start : int
+        Number of the first row.
+    """
+    f.write(header_line())
+    for rows in generate_rows(num_rows, year, seed, start):
+        f.write(b''.join(b','.join(row) + b'\n' for row in rows))
+
+
+def write_zip(path, num_rows, year=2010, seed=0, start=0):
+    """
+    Write synthetic beneficiary data to a zipped CSV file, like the CMS files.
+
+    Parameters
+    ----------
+    path : str, unicode
+        Path of the .zip file to write.
+    num_rows : int
+        Number of rows to generate.
+    year : int
+        Year of the data.
+    seed : int
+        Random seed.
+    start : int
+        Number of the first row.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_csv(f, num_rows, year, seed, start)
+        csv_name = os.path.basename(path).replace('.zip', '.csv')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as z:
+            z.write(tmp_path, csv_name)
+    finally:
+        os.remove(tmp_path)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Generate synthetic CMS summary beneficiary data.",
+        epilog="example: python synthetic.py --rows 1000000 --seed 1 "
+               "--out synthetic.csv")
+    argparser.add_argument("--rows", required=True, type=int,
+                           help="number of rows to generate")
+    argparser.add_argument("--year", required=False, type=int, default=2010,
+                           help="year of the data")
+    argparser.add_argument("--seed", required=False, type=int, default=0,
+                           help="random seed")
+    argparser.add_argument("--start", required=False, type=int, default=0,
+                           help="number of the first row, so files generated "
+                                "to load together have unique ids")
+    argparser.add_argument("--out", required=False,
+                           help="CSV file to write, or stdout if not given")
+    argparser.add_argument("--zip", action="store_true",
+                           help="write a zipped CSV file to --out")
+    args = argparser.parse_args()
+    started = time.time()
+    if args.zip:
+        if not args.out:
+            argparser.error("--zip needs --out")
+        write_zip(args.out, args.rows, args.year, args.seed, args.start)
+    elif args.out:
+        with open(args.out, 'wb') as f:
+            write_csv(f, args.rows, args.year, args.seed, args.start)
+    else:
+        write_csv(sys.stdout, args.rows, args.year, args.seed, args.start)
+    elapsed = time.time() - started
+    print("Generated {0:,d} rows in {1:.1f}s ({2:,.0f} rows/s).".format(
+          args.rows, elapsed, args.rows / elapsed), file=sys.stderr)
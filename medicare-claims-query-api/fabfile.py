@@ -1,8 +1,15 @@
 """Fabric configuration file for automated deployment."""
+import json
 import os
+import signal
 import subprocess
+import tempfile
+import time
+from StringIO import StringIO
 
-from fabric.api import run, sudo, put, env, require, local, settings
+import requests
+from fabric.api import (run, sudo, put, env, require, local, settings, abort,
+                        execute, parallel, runs_once)
 
 from db import config as awsconfig
 
@@ -33,8 +40,11 @@ INSTALL_PACKAGES = [
     "libffi-dev",
 ]
 
+# Postgres 11 or later is needed for the table partitioned by year
+POSTGRES_VERSION = "11"
+
 VAGRANT_PACKAGES = [
-    "postgresql-9.3",
+    "postgresql-" + POSTGRES_VERSION,
     "postgresql-contrib",
 ]
 
@@ -43,6 +53,9 @@ AWS_PACKAGES = [
     "supervisor",
 ]
 
+PROJECT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
 # Vagrant environment
 def vagrant():
     raw_ssh_config = subprocess.Popen(['vagrant', 'ssh-config'],
@@ -64,10 +77,17 @@ def vagrant():
     env.dbname = awsconfig.vagrant_dbname
     env.dbuser = awsconfig.vagrant_dbuser
     env.dbpass = awsconfig.vagrant_dbpass
+    env.app_hosts = env.hosts
 
 
 def aws():
     env.hosts = awsconfig.ec2_host
+    env.app_hosts = awsconfig.ec2_host
+    env.lb_host = awsconfig.ec2_lb_host
+    env.app_port = awsconfig.ec2_app_port
+    env.app_servers = ["{0}:{1}".format(host, awsconfig.ec2_app_port)
+                       for host in awsconfig.ec2_host]
+    env.pool_size = awsconfig.deploy_pool_size
     env.repo = ('env.medicare-api.com', 'origin', 'production')
     env.virtualenv, env.parent, env.branch = env.repo
     env.base = '/server'
@@ -83,6 +103,21 @@ def aws():
     env.dbpass = awsconfig.rds_dbpass
 
 
+def local_pool(ports="8001,8002,8003", app="server:app"):
+    """
+    Run the app as a pool of local gunicorn instances on the given ports, to
+    try out rolling restarts, e.g.
+    `fab local_pool start_local_pool rolling_restart stop_local_pool`.
+    """
+    env.local_pool = True
+    env.app_servers = ["127.0.0.1:{0}".format(port)
+                       for port in ports.split(",")]
+    env.local_app = app
+    # The generated nginx config is written here instead of to a server
+    env.nginx_conf = os.path.join(tempfile.gettempdir(),
+                                  "medicare_app_nginx.conf")
+
+
 def ssh():
     """SSH into a given environment."""
     require('hosts', provided_by=[vagrant, aws])
@@ -95,9 +130,21 @@ def ssh():
     local(cmd)
 
 
+@runs_once
 def bootstrap():
-    """Initialize the server or VM."""
+    """Initialize the servers or VM, setting up the app hosts in parallel."""
     require('hosts', provided_by=[vagrant, aws])
+    execute(sub_bootstrap_host, hosts=env.app_hosts)
+    # The database is shared, so only load it from one host
+    execute(sub_load_db, hosts=env.app_hosts[:1])
+    if not env.dev_mode:
+        execute(sub_setup_webserver, hosts=env.app_hosts)
+        execute(sub_configure_nginx, hosts=[env.lb_host])
+
+
+@parallel
+def sub_bootstrap_host():
+    """Install the app and its requirements on a host."""
     sub_install_packages()
     sub_make_virtualenv()
     if not env.dev_mode:
@@ -106,9 +153,6 @@ def bootstrap():
     sub_install_requirements()
     if not env.dev_mode:
         sub_copy_rds_password()  # Need this on the web server to connect to RDS
-    sub_load_db()
-    if not env.dev_mode:
-        sub_setup_webserver()
 
 
 def dev_server():
@@ -124,19 +168,71 @@ def cut_production():
           "git checkout master;")
 
 
+@parallel
 def pull():
-    """Pull a Git branch on the specified host."""
+    """Pull a Git branch on the specified hosts."""
     require('hosts', provided_by=[aws])
     run("cd %(base)s/%(virtualenv)s/project; "
         "git pull %(parent)s %(branch)s" % env)
 
 
+@runs_once
 def deploy():
-    """Update the app on AWS."""
+    """Update the app on AWS, restarting one host at a time."""
     require('hosts', provided_by=[aws])
     cut_production()
-    local('fab aws pull')
-    sudo("supervisorctl restart medicare_app")
+    execute(pull, hosts=env.app_hosts)
+    rolling_restart()
+
+
+@runs_once
+def rolling_restart():
+    """
+    Restart the app servers one at a time, so the others keep serving.
+
+    Each server is taken out of nginx's upstream and its in-flight requests
+    are let finish before it's restarted. It's put back once it passes its
+    health check and its cache has been warmed with deploy_warm_urls. If it
+    doesn't pass within deploy_health_timeout seconds, or any of the warm-up
+    requests fail, the deploy stops with that server left out, so a bad
+    release never reaches the rest.
+    """
+    require('app_servers', provided_by=[aws, local_pool])
+    for server in env.app_servers:
+        print "Draining {0}.".format(server)
+        sub_configure_upstream(down=[server])
+        sub_wait_drained(server)
+        print "Restarting {0}.".format(server)
+        sub_restart_app(server)
+        if not sub_wait_healthy(server):
+            abort("{0} didn't pass its health check within {1} seconds. It's "
+                  "been left out of the pool.".format(
+                      server, awsconfig.deploy_health_timeout))
+        print "Warming {0}.".format(server)
+        for path in awsconfig.deploy_warm_urls:
+            if sub_get(server, path) is None:
+                abort("{0} failed to answer {1} while warming up. It's been "
+                      "left out of the pool.".format(server, path))
+        sub_configure_upstream()
+    print "Restarted {0} servers.".format(len(env.app_servers))
+
+
+def start_local_pool():
+    """Start a local gunicorn instance on each port of the local pool."""
+    require('local_pool', provided_by=[local_pool])
+    for server in env.app_servers:
+        sub_start_local_app(server)
+    for server in env.app_servers:
+        if not sub_wait_healthy(server):
+            abort("{0} didn't start.".format(server))
+    sub_configure_upstream()
+
+
+def stop_local_pool():
+    """Stop the local gunicorn instances of the local pool."""
+    require('local_pool', provided_by=[local_pool])
+    for server in env.app_servers:
+        sub_stop_local_app(server)
 
 
 def sub_install_packages():
@@ -146,6 +242,12 @@ def sub_install_packages():
     # If Vagrant, install Postgres server so you can host DB on VM
     if env.dev_mode:
         package_str += " " + " ".join(VAGRANT_PACKAGES)
+        # Get a recent enough Postgres from the PostgreSQL apt repository
+        sudo("echo \"deb http://apt.postgresql.org/pub/repos/apt/ "
+             "$(lsb_release -cs)-pgdg main\" "
+             "> /etc/apt/sources.list.d/pgdg.list")
+        sudo("wget -q -O - https://www.postgresql.org/media/keys/ACCC4CF8.asc "
+             "| apt-key add -")
     else:
         package_str += " " + " ".join(AWS_PACKAGES)
     sudo("apt-get update")
@@ -190,7 +292,7 @@ def sub_setup_vagrant_db():
     """Creates the Vagrant user and database on its local Postgres server."""
     # Trust local connections so you can login as local users without password
     sudo("sed -i 's/[[:space:]]md5$/trust/' "
-         "/etc/postgresql/9.3/main/pg_hba.conf")
+         "/etc/postgresql/%s/main/pg_hba.conf" % POSTGRES_VERSION)
     # Restart server so changes can take effect
     sudo("service postgresql restart")
     # Create Postgres DB user and database, only warning if they already exist
@@ -224,6 +326,28 @@ def sub_load_db():
     run(command)
 
 
+def _nginx_conf(down=()):
+    """
+    Make the Nginx config for the Flask app from config/nginx.conf, balancing
+    requests across the app servers.
+
+    Parameters
+    ----------
+    down : list
+        App servers to leave out, e.g. while they're restarted.
+
+    Returns
+    -------
+    str
+        The config.
+    """
+    servers = "\n".join(
+        "    server {0}{1};".format(server, " down" if server in down else "")
+        for server in env.app_servers)
+    with open(os.path.join(PROJECT_DIR, "config", "nginx.conf")) as f:
+        return f.read() % {'servers': servers}
+
+
 def sub_configure_nginx():
     """Configure Nginx by removing default site and enabling our Flask app."""
     require('hosts', provided_by=[aws])
@@ -231,7 +355,7 @@ def sub_configure_nginx():
     # Delete default Nginx site and add config for Flask app
     with settings(warn_only=True):
         sudo("rm /etc/nginx/sites-enabled/default")
-    put("config/nginx.conf", "/etc/nginx/sites-available/medicare_app",
+    put(StringIO(_nginx_conf()), "/etc/nginx/sites-available/medicare_app",
         use_sudo=True)
     with settings(warn_only=True):
         sudo("ln -s /etc/nginx/sites-available/medicare_app "
@@ -239,11 +363,138 @@ def sub_configure_nginx():
     sudo("/etc/init.d/nginx restart")
 
 
+def sub_configure_upstream(down=()):
+    """Update Nginx's list of app servers and gracefully reload it."""
+    if env.get('local_pool'):
+        with open(env.nginx_conf, 'w') as f:
+            f.write(_nginx_conf(down))
+        return
+    with settings(host_string=env.lb_host):
+        put(StringIO(_nginx_conf(down)),
+            "/etc/nginx/sites-available/medicare_app", use_sudo=True)
+        sudo("nginx -s reload")
+
+
+def sub_get(server, path):
+    """
+    Request a path from an app server. On AWS the request is made on the
+    server itself, since the app's port isn't open to the internet.
+
+    Returns
+    -------
+    str
+        The response body, or None if the request failed.
+    """
+    if env.get('local_pool'):
+        try:
+            response = requests.get("http://{0}{1}".format(server, path),
+                                    timeout=10)
+        except requests.RequestException:
+            return None
+        return response.text if response.ok else None
+    with settings(host_string=server.split(':')[0], warn_only=True):
+        result = run("curl -sf 'http://localhost:{0}{1}'".format(
+            env.app_port, path), quiet=True)
+    return result if result.succeeded else None
+
+
+def sub_wait_healthy(server):
+    """
+    Wait up to deploy_health_timeout seconds for an app server to pass its
+    health check.
+
+    Returns
+    -------
+    bool
+        True if it passed.
+    """
+    deadline = time.time() + awsconfig.deploy_health_timeout
+    while time.time() < deadline:
+        if sub_get(server, "/api/v1/health") is not None:
+            return True
+        time.sleep(1)
+    return False
+
+
+def sub_wait_drained(server):
+    """
+    Wait up to deploy_drain_timeout seconds for an app server to finish the
+    requests it's running and has queued.
+    """
+    deadline = time.time() + awsconfig.deploy_drain_timeout
+    while time.time() < deadline:
+        status = sub_get(server, "/api/v1/status")
+        if status is None:
+            return
+        # The status request itself isn't admission controlled, so it doesn't
+        # count as active
+        busy = sum(limiter['active'] + limiter['queued']
+                   for limiter in json.loads(status)['queries'].values())
+        if busy == 0:
+            return
+        time.sleep(1)
+
+
+def sub_restart_app(server):
+    """Restart the app on an app server."""
+    if env.get('local_pool'):
+        sub_stop_local_app(server)
+        sub_start_local_app(server)
+        return
+    with settings(host_string=server.split(':')[0]):
+        sudo("supervisorctl restart medicare_app")
+
+
+def _local_pid_file(server):
+    """Get the pid file of a local pool app server."""
+    return os.path.join(tempfile.gettempdir(), "medicare_app_{0}.pid".format(
+        server.split(':')[1]))
+
+
+def sub_start_local_app(server):
+    """Start a local pool app server in the background."""
+    local("gunicorn {0} -b {1} --threads 32 --graceful-timeout 30 "
+          "--chdir {2} --pid {3} --daemon".format(
+              env.local_app, server, PROJECT_DIR, _local_pid_file(server)))
+
+
+def sub_stop_local_app(server):
+    """
+    Stop a local pool app server, letting its requests finish. If it hasn't
+    shut down within deploy_health_timeout seconds it's killed.
+    """
+    pid_file = _local_pid_file(server)
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read())
+        os.kill(pid, signal.SIGTERM)
+    except (IOError, OSError, ValueError):
+        return
+    # Gunicorn removes its pid file once it has shut down
+    deadline = time.time() + awsconfig.deploy_health_timeout
+    while os.path.exists(pid_file):
+        if time.time() >= deadline:
+            print "{0} didn't shut down, killing it.".format(server)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            try:
+                os.remove(pid_file)
+            except OSError:
+                pass
+            return
+        time.sleep(0.2)
+
+
 def sub_configure_gunicorn():
     """Configure Gunicorn in our virtualenv to run the Flask app."""
     require('hosts', provided_by=[aws])
-    put("config/supervisor_gunicorn.conf",
-        "/etc/supervisor/conf.d/medicare_app.conf", use_sudo=True)
+    with open(os.path.join(PROJECT_DIR, "config",
+                           "supervisor_gunicorn.conf")) as f:
+        conf = f.read() % {'app_port': env.app_port}
+    put(StringIO(conf), "/etc/supervisor/conf.d/medicare_app.conf",
+        use_sudo=True)
     with settings(warn_only=True):
         sudo("cd %(base)s/%(virtualenv)s; source bin/activate; "
              "pkill gunicorn" % env)
@@ -259,10 +510,10 @@ def sub_copy_rds_password():
     put("db/rds_password.py", "%(base)s/%(virtualenv)s/project/db" % env)
 
 
+@parallel
 def sub_setup_webserver():
-    """Configure Nginx and start Gunicorn with supervisor."""
+    """Start Gunicorn with supervisor on an app host."""
     require('hosts', provided_by=[aws])
-    sub_configure_nginx()
     with settings(warn_only=True):
         sudo("supervisorctl stop medicare_app")
     sub_configure_gunicorn()
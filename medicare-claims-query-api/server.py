@@ -6,24 +6,89 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import cProfile
+import gzip
+import hashlib
+import importlib
+import json
 import locale
 import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from io import BytesIO
 
 import psycopg2
 import psycopg2.extras
-from flask import Flask, jsonify
+from flask import Flask, g, request
 from collections import OrderedDict
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 import re
 
 re.sub
 
+from core import queries
+from core import schema
+from core.admission import ConcurrencyLimiter
+from core.replicas import ReplicaRouter
+from core.snapshot import Snapshot
 from core.utilities import cursor_connect
 from db import config as dbconfig
 
 app = Flask(__name__)
 
 TABLE_NAME = dbconfig.db_tablename
+VERSION_TABLE = dbconfig.db_version_tablename
+VERSION_SQL = "SELECT version FROM {0} WHERE table_name = %s;".format(
+    VERSION_TABLE)
+
+# Encoder of JSON responses, see api_json_module
+json_module = importlib.import_module(dbconfig.api_json_module)
+
+# Content encodings responses can be compressed with, in order of preference
+ENCODINGS = (['br'] if brotli is not None else []) + ['gzip']
+
+# Cached JSON response bodies keyed by request path, already encoded and with
+# each content encoding they've been compressed with. They are only valid for
+# the dataset version they were computed from, so the cache is cleared as soon
+# as the data loader swaps in a new version.
+CACHE_MAX_ENTRIES = 1024
+_cache = {}
+_cache_version = {'version': None}
+
+# The dataset version as last read from the primary, and when it was read. It's
+# only read again once it's db_version_check_interval seconds old, and by one
+# request at a time, so cache hits don't need a database connection.
+_dataset_version = {'version': None, 'checked': None}
+_dataset_version_lock = threading.Lock()
+
+# Columnar snapshot of the table written by the data loader, see
+# db_snapshot_path. It's mapped read-only, so its pages are shared by every
+# server process, and it's reopened when the loader replaces it.
+_snapshot = {'snapshot': None, 'inode': None}
+
+# Admission control for each class of query, see db_query_limits
+limiters = dict(
+    (name, ConcurrencyLimiter(limits[0], limits[1], dbconfig.db_queue_timeout))
+    for name, limits in dbconfig.db_query_limits.items())
+QUERY_TIMEOUTS = dict((name, limits[2])
+                      for name, limits in dbconfig.db_query_limits.items())
+
+# Approximate answers come with confidence intervals of APPROX_CONFIDENCE,
+# this many standard errors either side of the estimate
+APPROX_CONFIDENCE = 0.95
+APPROX_Z = 1.96
+
+# Most aggregates and grouped columns in one /api/v1/aggregate request
+MAX_AGGREGATES = 32
+MAX_GROUP_BY = 3
 
 locale.setlocale(locale.LC_ALL, '')  # For formatting numbers with commas
 
@@ -32,9 +97,128 @@ try:
     db_dsn = "host={0} dbname={1} user={2} password={3}".format(
         dbconfig.rds_dbhost, dbconfig.rds_dbname, dbconfig.rds_dbuser,
         dbconfig.rds_dbpass)
+    replica_dsns = [
+        "host={0} dbname={1} user={2} password={3}".format(
+            host, dbconfig.rds_dbname, dbconfig.rds_dbuser,
+            dbconfig.rds_dbpass)
+        for host in dbconfig.rds_replica_hosts]
 except ValueError:
     pass
 
+# Read-only queries go to the read replicas. The current dataset version is
+# read from the primary, where the data loader bumps it, but each query also
+# reads the version on its replica so that its result is cached under the
+# version of the data it was computed from, see query_connect().
+replicas = ReplicaRouter(db_dsn, replica_dsns, dbconfig.db_replica_max_lag,
+                         dbconfig.db_replica_check_interval)
+
+
+def json_default(obj):
+    """
+    Encode objects the JSON encoder can't, like dates, the same way as Flask.
+    """
+    return app.json_encoder().default(obj)
+
+
+def json_key(value):
+    """
+    Convert a value to use as a key of a JSON object, the way Flask's
+    jsonify() writes it.
+
+    The standard library's C encoder writes True and False keys as "True" and
+    "False", unlike its Python encoder, so booleans and None are converted to
+    "true", "false" and "null" first.
+
+    Parameters
+    ----------
+    value
+        A value from a query, e.g. of a column being counted.
+
+    Returns
+    -------
+    str, unicode, or the value unchanged
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+def json_response(*args, **kwargs):
+    """
+    Make a JSON response, like Flask's jsonify() but encoded with json_module,
+    without indentation or sorted keys, which would make the standard library
+    fall back from its C encoder to the much slower Python one.
+
+    Parameters
+    ----------
+    args, kwargs
+        The object to return, as for dict().
+
+    Returns
+    -------
+    response
+        A JSON response.
+    """
+    body = json_module.dumps(dict(*args, **kwargs), separators=(',', ':'),
+                             default=json_default)
+    return app.response_class(body, mimetype='application/json')
+
+
+def wants_columnar():
+    """
+    Check whether the request asks for the compact columnar shape of a
+    response, with `?columnar`.
+
+    Returns
+    -------
+    bool
+        True if it does.
+    """
+    return request.args.get('columnar') not in (None, '0')
+
+
+def content_encoding():
+    """
+    Choose how to compress the response to the request, from its
+    Accept-Encoding header.
+
+    Returns
+    -------
+    str
+        One of ENCODINGS, or None to not compress it.
+    """
+    for encoding in ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    """
+    Compress a response body.
+
+    Parameters
+    ----------
+    body : bytes
+        The body.
+    encoding : str
+        One of ENCODINGS.
+
+    Returns
+    -------
+    bytes
+        The compressed body.
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=dbconfig.api_brotli_quality)
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0,
+                       compresslevel=dbconfig.api_gzip_level) as f:
+        f.write(body)
+    return out.getvalue()
+
 
 def json_error(code, err):
     """
@@ -52,11 +236,636 @@ def json_error(code, err):
     response
         A JSON response.
     """
-    response = jsonify(error=err)
+    response = json_response(error=err)
     response.status_code = code
     return response
 
 
+@contextmanager
+def timed(phase):
+    """
+    Time a phase of handling the current request, for its Server-Timing
+    header. Time spent in the same phase more than once is added up.
+
+    Parameters
+    ----------
+    phase : str, unicode
+        Name of the phase, e.g. 'sql'.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        g.timings[phase] = g.timings.get(phase, 0) + time.time() - start
+
+
+@app.before_request
+def start_request():
+    """
+    Start timing the request, and start profiling it if it asks to be and
+    profiling is enabled.
+    """
+    g.start = time.time()
+    g.timings = OrderedDict()
+    if request.args.get('profile') not in (None, '0'):
+        if not dbconfig.api_profiling:
+            return json_error(403, "profiling is not enabled")
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Add a Server-Timing header with the time spent in each phase of the
+    request, replace the response with the profile if it was profiled, and
+    compress it if the client accepts it compressed.
+    """
+    if 'profiler' in g:
+        g.profiler.disable()
+        response = profile_response(g.profiler, response)
+    if (response.mimetype == 'application/json' and
+            not response.direct_passthrough and
+            'Content-Encoding' not in response.headers and
+            (response.content_length or 0) >=
+            dbconfig.api_compress_min_bytes):
+        # Compress responses that weren't compressed by the cache
+        response.vary.add('Accept-Encoding')
+        encoding = content_encoding()
+        if encoding is not None:
+            with timed('compress'):
+                response.set_data(compress(response.get_data(), encoding))
+            response.headers['Content-Encoding'] = encoding
+    g.timings['total'] = time.time() - g.start
+    response.headers['Server-Timing'] = ", ".join(
+        "{0};dur={1:.1f}".format(phase, seconds * 1000)
+        for phase, seconds in g.timings.items())
+    return response
+
+
+@app.teardown_request
+def stop_profiling(exc):
+    """
+    Stop profiling a request that was profiled, even if it raised an error.
+    """
+    if 'profiler' in g:
+        g.profiler.disable()
+
+
+def profile_response(profiler, response):
+    """
+    Make a JSON response with the functions a profiled request spent the most
+    time in, saving the full profile to api_profile_dir if it's set.
+
+    Parameters
+    ----------
+    profiler : cProfile.Profile
+        The request's profiler, already disabled.
+    response : response
+        The request's response.
+
+    Returns
+    -------
+    response
+        A JSON response with the status of the original response, the time
+        spent in each phase of the request, and the api_profile_top functions
+        with the most cumulative time.
+    """
+    if dbconfig.api_profile_dir:
+        filename = "{0:.0f}{1}.prof".format(
+            time.time() * 1000, re.sub('\W+', '_', request.path))
+        profiler.dump_stats(os.path.join(dbconfig.api_profile_dir, filename))
+    stats = pstats.Stats(profiler)
+    stats.sort_stats('cumulative')
+    functions = []
+    for func in stats.fcn_list[:dbconfig.api_profile_top]:
+        calls, _, total, cumulative, _ = stats.stats[func]
+        functions.append({
+            'function': "{0}:{1}({2})".format(*func),
+            'calls': calls,
+            'total_seconds': round(total, 6),
+            'cumulative_seconds': round(cumulative, 6),
+        })
+    return json_response(status=response.status_code,
+                         timings=dict((phase, round(seconds, 6))
+                                      for phase, seconds in g.timings.items()),
+                         profile=functions)
+
+
+def overloaded():
+    """
+    Make a JSON response telling the client the server is too busy to answer
+    and when to try again.
+
+    Returns
+    -------
+    response
+        A 503 JSON response with a Retry-After header.
+    """
+    response = json_error(503, "server is busy, try again later")
+    response.headers['Retry-After'] = str(dbconfig.db_retry_after)
+    return response
+
+
+def parse_years(value):
+    """
+    Parse the `year` query parameter of a request into a range of years.
+
+    Parameters
+    ----------
+    value : str, unicode
+        A single year like '2010', a range of years like '2008-2009', or 'all'.
+        If None, the default year is used.
+
+    Returns
+    -------
+    (int, int)
+        A tuple of (first year, last year), or (None, None) for all years.
+
+    Raises
+    ------
+    ValueError
+        If the value isn't a year, range of years, or 'all', or any year is
+        not available.
+    """
+    if value is None:
+        return dbconfig.db_default_year, dbconfig.db_default_year
+    if value == 'all':
+        return None, None
+    error = ValueError(
+        "year must be one of {0}, a range like {1}-{2}, or 'all'".format(
+            ", ".join(str(year) for year in dbconfig.db_years),
+            dbconfig.db_years[0], dbconfig.db_years[-1]))
+    parts = value.split('-')
+    if len(parts) > 2 or not all(part.isdigit() for part in parts):
+        raise error
+    first, last = int(parts[0]), int(parts[-1])
+    if (first > last or first not in dbconfig.db_years or
+            last not in dbconfig.db_years):
+        raise error
+    return first, last
+
+
+def parse_approx(value):
+    """
+    Parse the `approx` query parameter of a request into the percent of the
+    table to sample.
+
+    Parameters
+    ----------
+    value : str, unicode
+        A percent greater than 0 and at most 100, or '' for the default
+        percent. If None, the query isn't approximated.
+
+    Returns
+    -------
+    float
+        The percent of the table to sample, or None to not sample it.
+
+    Raises
+    ------
+    ValueError
+        If the value isn't a percent greater than 0 and at most 100.
+    """
+    if value is None:
+        return None
+    if value == '':
+        return float(dbconfig.db_approx_percent)
+    error = ValueError("approx must be a percent greater than 0 and at most "
+                       "100")
+    try:
+        percent = float(value)
+    except ValueError:
+        raise error
+    if not 0 < percent <= 100:
+        raise error
+    return percent
+
+
+def parse_aggregates(value):
+    """
+    Parse the `agg` query parameter of a request into a list of aggregates.
+
+    Parameters
+    ----------
+    value : str, unicode
+        Comma-separated aggregates and column names, e.g.
+        'count:*,avg:inpatient_reimbursement'.
+
+    Returns
+    -------
+    list
+        Tuples of (aggregate, column name), for queries.compile_aggregates().
+
+    Raises
+    ------
+    ValueError
+        If the value is missing or malformed, or has more than
+        MAX_AGGREGATES aggregates.
+    """
+    error = ValueError("agg must be a comma-separated list of "
+                       "<aggregate>:<column>, e.g. count:*,avg:cancer")
+    if not value:
+        raise error
+    aggregates = []
+    for part in value.split(','):
+        aggregate, sep, col = part.strip().partition(':')
+        if not sep:
+            raise error
+        aggregates.append((aggregate, col))
+    if len(aggregates) > MAX_AGGREGATES:
+        raise ValueError("at most {0} aggregates are allowed".format(
+            MAX_AGGREGATES))
+    return aggregates
+
+
+def get_dataset_version():
+    """
+    Get the version of the loaded data, which is bumped by the data loader
+    every time it swaps in a new table.
+
+    Returns
+    -------
+    int
+        The dataset version, or None if it can't be read.
+    """
+    try:
+        con, cur = cursor_connect(db_dsn)
+        cur.execute(VERSION_SQL, (TABLE_NAME, ))
+        result = cur.fetchone()
+        cur.close()
+        con.close()
+    except psycopg2.Error:
+        return None
+    if result is None:
+        return None
+    return result[0]
+
+
+def current_version():
+    """
+    Get the dataset version, reading it from the primary if it was last read
+    more than db_version_check_interval seconds ago.
+
+    While one request reads it, others carry on with the version it was last
+    read as, unless it hasn't been read yet.
+
+    Returns
+    -------
+    int
+        The dataset version, or None if it couldn't be read.
+    """
+    def due():
+        checked = _dataset_version['checked']
+        return (checked is None or time.time() - checked >=
+                dbconfig.db_version_check_interval)
+    if due() and _dataset_version_lock.acquire(
+            _dataset_version['checked'] is None):
+        try:
+            if due():
+                _dataset_version['version'] = get_dataset_version()
+                _dataset_version['checked'] = time.time()
+        finally:
+            _dataset_version_lock.release()
+    return _dataset_version['version']
+
+
+def query_connect(query_class, cursor_factory=None):
+    """
+    Connect to a read replica to run a query, and read the dataset version on
+    the same connection.
+
+    The version is kept in `g.query_version` for cached(), since a replica
+    that lags behind the primary may still be serving the previous version of
+    the data. It's read before the query, so the query sees at least that
+    version of the data.
+
+    Parameters
+    ----------
+    query_class : str, unicode
+        A query class in db_query_limits, for its statement timeout.
+    cursor_factory : psycopg2.extras
+        An optional psycopg2 cursor type, e.g. DictCursor.
+
+    Returns
+    -------
+    (psycopg2.extensions.connection, psycopg2.extensions.cursor)
+        A tuple of (psycopg2 connection, psycopg2 cursor).
+    """
+    con, cur = replicas.connect(cursor_factory, QUERY_TIMEOUTS[query_class])
+    try:
+        version_cur = con.cursor()
+        version_cur.execute(VERSION_SQL, (TABLE_NAME, ))
+        result = version_cur.fetchone()
+        version_cur.close()
+    except psycopg2.Error:
+        # The route never gets the connection, so it can't close it
+        cur.close()
+        con.close()
+        raise
+    g.query_version = result[0] if result is not None else None
+    return con, cur
+
+
+def get_snapshot():
+    """
+    Get the memory-mapped snapshot of the table, reopening it if the data
+    loader has replaced it since it was opened.
+
+    Returns
+    -------
+    snapshot.Snapshot
+        The snapshot, or None if there's no snapshot to read.
+    """
+    path = dbconfig.db_snapshot_path
+    if not path:
+        return None
+    try:
+        inode = os.stat(path).st_ino
+        if inode != _snapshot['inode']:
+            # The old snapshot is unmapped once no request is reading it
+            _snapshot['snapshot'] = Snapshot(path)
+            _snapshot['inode'] = inode
+    except (IOError, OSError, ValueError):
+        return None
+    return _snapshot['snapshot']
+
+
+def summary_exists(cur, view):
+    """
+    Check whether the data loader has built a summary view of TABLE_NAME.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        Cursor to check with.
+    view : str, unicode
+        One of queries.SUMMARY_VIEWS.
+
+    Returns
+    -------
+    bool
+        True if the view exists.
+    """
+    with timed('sql'):
+        cur.execute("SELECT to_regclass(%s);",
+                    (queries.summary_view_name(TABLE_NAME, view), ))
+        return cur.fetchone()[0] is not None
+
+
+def interval(estimate, std_error, minimum=None):
+    """
+    Make a confidence interval around an estimate.
+
+    Parameters
+    ----------
+    estimate : float
+        The estimate.
+    std_error : float
+        The estimate's standard error.
+    minimum : float
+        Optional lowest possible value, to clip the interval at.
+
+    Returns
+    -------
+    dict
+        The estimate and the lower and upper bounds of its APPROX_CONFIDENCE
+        confidence interval.
+    """
+    margin = APPROX_Z * (std_error or 0)
+    lower = estimate - margin
+    if minimum is not None:
+        lower = max(lower, minimum)
+    return {'estimate': estimate, 'lower': lower, 'upper': estimate + margin}
+
+
+def approx_response(percent, sample_rows, **kwargs):
+    """
+    Make a JSON response for an approximate answer.
+
+    Parameters
+    ----------
+    percent : float
+        The percent of the table that was sampled.
+    sample_rows : int
+        The number of rows in the sample.
+    kwargs
+        The answer, as for json_response().
+
+    Returns
+    -------
+    response
+        A JSON response with the answer, flagged as approximate.
+    """
+    with timed('serialize'):
+        return json_response(approximate=True, sample_percent=percent,
+                             sample_rows=int(sample_rows),
+                             confidence=APPROX_CONFIDENCE, **kwargs)
+
+
+def approx_counts(cur, col, years, percent):
+    """
+    Estimate counts of distinct values in a column from a sample of the table.
+
+    Parameters
+    ----------
+    cur : psycopg2.extras.DictCursor
+        Cursor to query with.
+    col : str, unicode
+        The name of a column, already checked against a whitelist.
+    years : str, unicode
+        A condition from queries.year_filter().
+    percent : float
+        The percent of the table to sample.
+
+    Returns
+    -------
+    response
+        A JSON response with an estimate and confidence interval for each
+        value's count.
+    """
+    count = {}
+    sample_rows = 0
+    query = queries.APPROX_COUNT_SQL.format(col=col, table=TABLE_NAME,
+                                            years=years)
+    with timed('sql'):
+        cur.execute(query, {'percent': percent, 'fraction': percent / 100})
+    with timed('fetch'):
+        result = cur.fetchall()
+    for row in result:
+        estimate = interval(float(row['estimate']), float(row['std_error']),
+                            minimum=0)
+        count[json_key(row[col])] = dict((k, int(round(v)))
+                                         for k, v in estimate.items())
+        sample_rows += row['sample_rows']
+    return approx_response(percent, sample_rows, count=count)
+
+
+def approx_average(cur, col, years, percent):
+    """
+    Estimate the average value of a column from a sample of the table.
+
+    Parameters
+    ----------
+    cur : psycopg2.extras.DictCursor
+        Cursor to query with.
+    col : str, unicode
+        The name of a column, already checked against a whitelist.
+    years : str, unicode
+        A condition from queries.year_filter().
+    percent : float
+        The percent of the table to sample.
+
+    Returns
+    -------
+    response
+        A JSON response with an estimate and confidence interval for the
+        column's average, or null if the sample was empty.
+    """
+    query = queries.APPROX_AVERAGE_SQL.format(col=col, table=TABLE_NAME,
+                                              years=years)
+    with timed('sql'):
+        cur.execute(query, {'percent': percent, 'fraction': percent / 100})
+    with timed('fetch'):
+        row = cur.fetchone()
+    if row is None or row['avg'] is None:
+        return approx_response(percent, 0, average={col: None})
+    estimate = interval(row['avg'], row['std_error'])
+    return approx_response(
+        percent, row['sample_rows'],
+        average={col: dict((k, round(v, 2)) for k, v in estimate.items())})
+
+
+def approx_frequency(cur, col, years, percent):
+    """
+    Estimate the frequency of disease claims in each state from a sample of
+    the table.
+
+    Parameters
+    ----------
+    cur : psycopg2.extras.DictCursor
+        Cursor to query with.
+    col : str, unicode
+        The name of a disease column, already checked against a whitelist.
+    years : str, unicode
+        A condition from queries.year_filter().
+    percent : float
+        The percent of the table to sample.
+
+    Returns
+    -------
+    response
+        A JSON response with an estimate and confidence interval for each
+        state's frequency, in descending order of the estimates.
+    """
+    disease = []
+    sample_rows = 0
+    query = queries.APPROX_FREQ_SQL.format(col=col, table=TABLE_NAME,
+                                           years=years)
+    with timed('sql'):
+        cur.execute(query, {'percent': percent, 'fraction': percent / 100})
+    with timed('fetch'):
+        result = cur.fetchall()
+    for row in result:
+        disease.append({row['state']: interval(
+            row['frequency'], row['std_error'], minimum=0)})
+        sample_rows += row['sample_rows']
+    if wants_columnar():
+        return approx_response(
+            percent, sample_rows,
+            states=[list(freq.keys())[0] for freq in disease],
+            frequencies=[list(freq.values())[0] for freq in disease])
+    return approx_response(percent, sample_rows, state_depression=disease)
+
+
+def cached(f):
+    """
+    Decorate a route to cache its JSON responses until the dataset version
+    changes.
+
+    Responses are cached as encoded JSON, and compressed with each content
+    encoding clients ask for the first time one does, so cache hits skip both
+    serialization and compression. Cached responses carry an ETag, so clients
+    can revalidate them with If-None-Match and get a 304 Not Modified if
+    they're unchanged. The dataset version is only read from the database
+    every db_version_check_interval seconds, see current_version(), and
+    responses computed on a replica with a different version of the data
+    aren't cached. Errors are never cached, and if the dataset version can't
+    be read the cache is bypassed entirely. So are profiled requests, so the
+    profile shows the work of answering them.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if 'profiler' in g:
+            return f(*args, **kwargs)
+        with timed('version'):
+            version = current_version()
+        if version is None:
+            return f(*args, **kwargs)
+        if version != _cache_version['version']:
+            _cache.clear()
+            _cache_version['version'] = version
+        key = request.full_path
+        cached_response = _cache.get(key)
+        if cached_response is None:
+            response = f(*args, **kwargs)
+            body = response.get_data()
+            if response.status_code != 200 or 'error' in json.loads(body):
+                return response
+            if getattr(g, 'query_version', None) != version:
+                # Computed from a replica that hasn't caught up with the
+                # primary yet, or that has already seen a newer version
+                return response
+            etag = "{0}-{1}".format(version, hashlib.sha1(body).hexdigest())
+            if len(_cache) >= CACHE_MAX_ENTRIES:
+                _cache.clear()
+            cached_response = _cache[key] = ({None: body}, etag)
+        bodies, etag = cached_response
+        encoding = None
+        if len(bodies[None]) >= dbconfig.api_compress_min_bytes:
+            encoding = content_encoding()
+        if encoding not in bodies:
+            with timed('compress'):
+                bodies[encoding] = compress(bodies[None], encoding)
+        response = app.response_class(bodies[encoding],
+                                      mimetype='application/json')
+        if encoding is not None:
+            # Each encoding of the response needs its own ETag
+            response.headers['Content-Encoding'] = encoding
+            etag = "{0}-{1}".format(etag, encoding)
+        if len(bodies[None]) >= dbconfig.api_compress_min_bytes:
+            response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+    return decorated
+
+
+def admitted(query_class):
+    """
+    Decorate a route to only run when its query class's limiter admits it,
+    and to answer with a 503 if it isn't admitted.
+
+    Parameters
+    ----------
+    query_class : str, unicode
+        A query class in db_query_limits.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            limiter = limiters[query_class]
+            with timed('queue'):
+                admitted = limiter.acquire()
+            if not admitted:
+                return overloaded()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                limiter.release()
+        return decorated
+    return decorator
+
+
 @app.route('/')
 def index():
     """
@@ -71,7 +880,7 @@ def index():
     """
     num_rows = 0  # Default value
     try:
-        con, cur = cursor_connect(db_dsn)
+        con, cur = replicas.connect()
         sql = "SELECT COUNT(*) FROM {0}".format(TABLE_NAME)
         cur.execute(sql)
         result = cur.fetchone()
@@ -84,7 +893,12 @@ def index():
         <body>
         <div>
             <p>Hello World! I can access {0:,d} rows of data!</p>
-            <p>The data is from the 2010 Medicare synthetic claims summary.</p>
+            <p>The data is from the 2008-2010 Medicare synthetic claims
+                summary. Add <code>?year=2009</code>,
+                <code>?year=2008-2009</code> or <code>?year=all</code> to any
+                query to choose years (2010 by default). Add
+                <code>?approx=1</code> to get a quick estimate from a 1%
+                sample instead.</p>
             <p>Number of claims by sex:
                 <a href="/api/v1/count/sex">/api/v1/count/sex</a>
             </p>
@@ -111,6 +925,11 @@ def index():
                 <a href="/api/v1/freq/cancer">
                     /api/v1/freq/cancer</a>
             </p>
+            <p>Claims, cancer rate and average inpatient reimbursement by
+                state, in one query:
+                <a href="/api/v1/aggregate?agg=count:*,avg:cancer,avg:inpatient_reimbursement&by=state">
+                    /api/v1/aggregate?agg=count:*,avg:cancer,avg:inpatient_reimbursement&amp;by=state</a>
+            </p>
         </div>
         </body>
         </html>
@@ -119,6 +938,8 @@ def index():
 
 
 @app.route('/api/v1/count/<col>')
+@cached
+@admitted("count")
 def get_counts(col):
     """
     Get counts of distinct values in the available columns.
@@ -137,28 +958,51 @@ def get_counts(col):
     --------
     /api/v1/count/race
     /api/v1/count/cancer
+    /api/v1/count/cancer?year=2008-2010
+    /api/v1/count/county_code?approx=1
     """
     count = {}
     cleaned_col = re.sub('\W+', '', col)
     try:
-        if cleaned_col == 'id':
+        years = queries.year_filter(*parse_years(request.args.get('year')))
+        percent = parse_approx(request.args.get('approx'))
+    except ValueError as e:
+        return json_error(400, e.message)
+    try:
+        if not schema.allows(cleaned_col, 'count'):
             return json_error(403,
                               "column '{0}' is not allowed".format(cleaned_col))
-        con, cur = cursor_connect(db_dsn, psycopg2.extras.DictCursor)
-        query = """
-        SELECT {0}, COUNT(*) AS num FROM {1}
-        GROUP BY {0};""".format(cleaned_col, TABLE_NAME)
-        cur.execute(query, (cleaned_col, ))
-        result = cur.fetchall()
-        for row in result:
-            label = row[cleaned_col]
-            count[label] = row['num']
+        with timed('connect'):
+            con, cur = query_connect("count", psycopg2.extras.DictCursor)
+        if percent is not None:
+            return approx_counts(cur, cleaned_col, years, percent)
+        if (cleaned_col in dbconfig.db_summary_count_columns and
+                summary_exists(cur, "counts")):
+            query = queries.SUMMARY_COUNT_SQL.format(
+                col=cleaned_col, years=years,
+                table=queries.summary_view_name(TABLE_NAME, "counts"))
+        else:
+            query = queries.COUNT_SQL.format(col=cleaned_col,
+                                             table=TABLE_NAME, years=years)
+        with timed('sql'):
+            cur.execute(query, (cleaned_col, ))
+        with timed('fetch'):
+            result = cur.fetchall()
+        with timed('process'):
+            for row in result:
+                label = json_key(row[cleaned_col])
+                count[label] = row['num']
+    except psycopg2.extensions.QueryCanceledError:
+        return overloaded()
     except Exception as e:
-        return jsonify({'error': e.message})
-    return jsonify(count)
+        return json_response({'error': e.message})
+    with timed('serialize'):
+        return json_response(count)
 
 
 @app.route('/api/v1/average/<col>')
+@cached
+@admitted("average")
 def get_average(col):
     """
     Get the average value from a column.
@@ -175,40 +1019,49 @@ def get_average(col):
         that column as the value, as the value for key 'average'.
     """
     avg = {}
-    # Only allow average value computation on certain (numeric) columns
-    accepted_cols = (
-        "inpatient_reimbursement",
-        "inpatient_beneficiary_responsibility",
-        "inpatient_primary_payer_reimbursement",
-        "outpatient_reimbursement",
-        "outpatient_beneficiary_responsibility",
-        "outpatient_primary_payer_reimbursement",
-        "carrier_reimbursement",
-        "beneficiary_responsibility",
-        "primary_payer_reimbursement",
-        "part_a_coverage_months",
-        "part_b_coverage_months",
-        "hmo_coverage_months",
-        "part_d_coverage_months",
-    )
+    # Only allow average value computation on numeric columns
+    accepted_cols = schema.columns("numeric")
     # Strip the user input to alpha characters only
     cleaned_col = re.sub('\W+', '', col)
+    try:
+        years = queries.year_filter(*parse_years(request.args.get('year')))
+        percent = parse_approx(request.args.get('approx'))
+    except ValueError as e:
+        return json_error(400, e.message)
     try:
         if cleaned_col not in accepted_cols:
             return json_error(403,
                               "column '{0}' is not allowed".format(cleaned_col))
-        con, cur = cursor_connect(db_dsn, psycopg2.extras.DictCursor)
-        query = "SELECT AVG({0}) FROM {1};".format(cleaned_col, TABLE_NAME)
-        cur.execute(query, (cleaned_col, ))
-        result = cur.fetchall()
-        for row in result:
-            avg[cleaned_col] = round(row['avg'], 2)
+        with timed('connect'):
+            con, cur = query_connect("average", psycopg2.extras.DictCursor)
+        if percent is not None:
+            return approx_average(cur, cleaned_col, years, percent)
+        if (cleaned_col in dbconfig.db_summary_average_columns and
+                summary_exists(cur, "averages")):
+            query = queries.SUMMARY_AVERAGE_SQL.format(
+                col=cleaned_col, years=years,
+                table=queries.summary_view_name(TABLE_NAME, "averages"))
+        else:
+            query = queries.AVERAGE_SQL.format(col=cleaned_col,
+                                               table=TABLE_NAME, years=years)
+        with timed('sql'):
+            cur.execute(query, (cleaned_col, ))
+        with timed('fetch'):
+            result = cur.fetchall()
+        with timed('process'):
+            for row in result:
+                avg[cleaned_col] = round(row['avg'], 2)
+    except psycopg2.extensions.QueryCanceledError:
+        return overloaded()
     except Exception as e:
-        return jsonify({'error': e.message})
-    return jsonify({'average': avg})
+        return json_response({'error': e.message})
+    with timed('serialize'):
+        return json_response({'average': avg})
 
 
 @app.route('/api/v1/freq/<col>')
+@cached
+@admitted("freq")
 def disease_frequency(col):
     """
     Get the states in descending order of the percentage of disease claims,
@@ -223,51 +1076,165 @@ def disease_frequency(col):
     -------
     json
         A labeled JSON object with the state and percent disease claims out
-        of all of that state's claims.
+        of all of that state's claims. With `?columnar`, the states and their
+        frequencies are returned as two parallel lists instead.
 
     Examples
     --------
     /api/v1/freq/depression
-    /api/v1/freq/diabetes
+    /api/v1/freq/diabetes?year=2009
+    /api/v1/freq/diabetes?approx=5
+    /api/v1/freq/cancer?columnar
     """
     disease = []
-    accepted_cols = (
-        "end_stage_renal_disease",
-        "alzheimers_related_senile",
-        "heart_failure",
-        "chronic_kidney",
-        "cancer",
-        "chronic_obstructive_pulmonary",
-        "depression",
-        "diabetes",
-        "ischemic_heart",
-        "osteoporosis",
-        "rheumatoid_osteo_arthritis",
-        "stroke_ischemic_attack",
-    )
+    accepted_cols = schema.columns("boolean")
     # Strip the user input to alpha characters only
     cleaned_col = re.sub('\W+', '', col)
+    try:
+        years = queries.year_filter(*parse_years(request.args.get('year')))
+        percent = parse_approx(request.args.get('approx'))
+    except ValueError as e:
+        return json_error(400, e.message)
     try:
         if cleaned_col not in accepted_cols:
             return json_error(403,
                               "column '{0}' is not allowed".format(cleaned_col))
-        con, cur = cursor_connect(db_dsn, psycopg2.extras.DictCursor)
-        query = """
-        SELECT state, {1}/claims::float AS frequency FROM (SELECT
-        LHS.state AS state, {1}, claims FROM (SELECT state, count(*) AS
-        claims FROM {0} GROUP BY state order by claims desc)
-        AS LHS LEFT JOIN (SELECT state, count(*) AS {1} FROM
-        {0} WHERE {1}='true' GROUP BY state) AS RHS
-        ON LHS.state=RHS.state) AS outer_q
-        ORDER by frequency DESC;""".format(TABLE_NAME, cleaned_col)
-        cur.execute(query)
-        result = cur.fetchall()
-        for row in result:
-            freq = {row['state']: row['frequency']}
-            disease.append(freq)
+        with timed('connect'):
+            con, cur = query_connect("freq", psycopg2.extras.DictCursor)
+        if percent is not None:
+            return approx_frequency(cur, cleaned_col, years, percent)
+        if (cleaned_col in dbconfig.db_disease_columns and
+                summary_exists(cur, "state_totals")):
+            query = queries.SUMMARY_FREQ_SQL.format(
+                col=cleaned_col, years=years,
+                table=queries.summary_view_name(TABLE_NAME, "state_totals"))
+        else:
+            query = queries.FREQ_SQL.format(col=cleaned_col, table=TABLE_NAME,
+                                            years=years)
+        with timed('sql'):
+            cur.execute(query)
+        with timed('fetch'):
+            result = cur.fetchall()
+        if wants_columnar():
+            with timed('process'):
+                states = [row['state'] for row in result]
+                frequencies = [row['frequency'] for row in result]
+            with timed('serialize'):
+                return json_response(states=states, frequencies=frequencies)
+        with timed('process'):
+            for row in result:
+                freq = {row['state']: row['frequency']}
+                disease.append(freq)
+    except psycopg2.extensions.QueryCanceledError:
+        return overloaded()
     except Exception as e:
-        return jsonify({'error': e.message})
-    return jsonify(state_depression=disease)
+        return json_response({'error': e.message})
+    with timed('serialize'):
+        return json_response(state_depression=disease)
+
+
+@app.route('/api/v1/aggregate')
+@cached
+@admitted("aggregate")
+def aggregate():
+    """
+    Compute any number of aggregates over any columns in a single scan of the
+    table, optionally grouped by up to MAX_GROUP_BY columns.
+
+    The aggregates are given by the `agg` parameter as a comma-separated list
+    of <aggregate>:<column>. The aggregates allowed on each column are set in
+    the schema registry: count, sum, avg, min, max and stddev on numeric
+    columns; count, sum and avg on boolean columns (true counts as 1); and
+    count:* to count rows. The columns to group by are given by the `by`
+    parameter, also comma-separated, and must be categorical or boolean.
+
+    Returns
+    -------
+    json
+        A list of rows, with each grouped column and each aggregate, named
+        <aggregate>_<column>, or 'count' for count:*. With `?columnar`, a
+        list of values for each grouped column and aggregate instead.
+
+    Examples
+    --------
+    /api/v1/aggregate?agg=avg:inpatient_reimbursement,max:inpatient_reimbursement
+    /api/v1/aggregate?agg=count:*,avg:cancer,avg:diabetes&by=state
+    /api/v1/aggregate?agg=sum:carrier_reimbursement&by=year,sex&year=all
+    /api/v1/aggregate?agg=count:*&by=state&columnar
+    """
+    try:
+        years = queries.year_filter(*parse_years(request.args.get('year')))
+        aggregates = parse_aggregates(request.args.get('agg'))
+        by = request.args.get('by')
+        group_by = [col.strip() for col in by.split(',')] if by else []
+        if len(group_by) > MAX_GROUP_BY:
+            raise ValueError("at most {0} columns can be grouped by".format(
+                MAX_GROUP_BY))
+        query = queries.compile_aggregates(aggregates, group_by, TABLE_NAME,
+                                           years)
+    except ValueError as e:
+        return json_error(400, e.message)
+    try:
+        with timed('connect'):
+            con, cur = query_connect("aggregate",
+                                     psycopg2.extras.RealDictCursor)
+        with timed('sql'):
+            cur.execute(query)
+        with timed('fetch'):
+            result = cur.fetchall()
+        if wants_columnar():
+            with timed('process'):
+                result = OrderedDict(
+                    (desc[0], [row[desc[0]] for row in result])
+                    for desc in cur.description)
+    except psycopg2.extensions.QueryCanceledError:
+        return overloaded()
+    except Exception as e:
+        return json_response({'error': e.message})
+    with timed('serialize'):
+        return json_response(aggregates=result)
+
+
+@app.route('/api/v1/health')
+def health():
+    """
+    Check whether the server is ready to answer queries, for load balancers
+    and rolling restarts.
+
+    Returns
+    -------
+    json
+        The dataset version, or a 503 error if the database can't be read.
+    """
+    version = get_dataset_version()
+    if version is None:
+        return json_error(503, "database is unavailable")
+    return json_response(status="ok", version=version)
+
+
+@app.route('/api/v1/status')
+def status():
+    """
+    Get the load on the server.
+
+    Returns
+    -------
+    json
+        For each query class, the number of requests running and queued, and
+        the number admitted and rejected so far. Also the health of the read
+        replicas, the size of the result cache, and the snapshot's dataset
+        version and number of rows.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        snapshot = {'rows': snapshot.rows,
+                    'version': snapshot.dataset_version}
+    return json_response(
+        queries=dict((name, limiter.status())
+                     for name, limiter in limiters.items()),
+        replicas=replicas.status(),
+        cache={'entries': len(_cache), 'version': _cache_version['version']},
+        snapshot=snapshot)
 
 
 if __name__ == '__main__':
@@ -280,4 +1247,5 @@ if __name__ == '__main__':
         db_dsn = "host={0} dbname={1} user={2}".format(dbconfig.vagrant_dbhost,
                                                        dbconfig.vagrant_dbname,
                                                        dbconfig.vagrant_dbuser)
+        replicas = ReplicaRouter(db_dsn, [])
         app.run(host='0.0.0.0', debug=True)